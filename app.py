@@ -1,251 +1,2295 @@
-from flask import Flask, request, jsonify, send_from_directory
+import time
+# Measured from the top of the module so the startup report includes imports
+IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import sys
 from datetime import datetime, timezone
-import google.generativeai as genai
+import gzip
 import json
-import traceback
+import logging
+import logging.handlers
+import queue
+import sqlite3
+import random
+import secrets
+import abc
+import atexit
+import re
+import bisect
+import contextlib
+import contextvars
+import copy
+import functools
+import hashlib
+import inspect
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from search import SNIPPET_MARK, SNIPPET_WORDS, MessageIndex, make_snippet, search_terms
+
+load_dotenv()
+
+# Logging: records are handed to a bounded queue and written to stdout by a
+# background thread, so request threads never block on the terminal or log
+# collector. LOG_FORMAT=json emits one JSON object per line with the record's
+# structured fields. Request bodies are only logged at LOG_LEVEL=DEBUG, and
+# LOG_SAMPLE_RATE thins out per-request access lines under load.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Fields that are never written out; chat text is replaced by its length
+SECRET_LOG_FIELDS = {'password', 'password_hash', 'token', 'api_key'}
+CHAT_TEXT_LOG_FIELDS = {'message', 'user_message', 'content', 'response', 'summary', 'text'}
+
+
+def log_fields(**fields):
+    """Structured fields for a log call: log.info("...", extra=log_fields(user_id=...))"""
+    return {'fields': fields}
+
+
+def redact(value, key=None):
+    """Copy of a log field with secrets masked and chat text reduced to its length
+    
+    Values that aren't plain JSON types are copied as their str(), which is
+    also how they would be written out.
+    """
+    if key in SECRET_LOG_FIELDS:
+        return '***'
+    if key in CHAT_TEXT_LOG_FIELDS and isinstance(value, str):
+        return f"<{len(value)} chars>"
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Text or JSON lines including the record's redacted structured fields"""
+    
+    def __init__(self, json_lines=False):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+        self.json_lines = json_lines
+    
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if not getattr(record, 'fields_redacted', False):
+            fields = redact(fields)
+        if self.json_lines:
+            entry = {
+                "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                "level": record.levelname,
+                "message": record.getMessage()
+            }
+            for key, value in fields.items():
+                entry.setdefault(key, value)
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                entry["exception"] = record.exc_text
+            return json.dumps(entry, default=str, ensure_ascii=False)
+        line = super().format(record)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={json.dumps(value, default=str)}" for key, value in fields.items())
+        return line
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves the output formatting to the writer thread
+    
+    Records marked extra={'sampled': True} are kept with probability
+    LOG_SAMPLE_RATE, and records arriving while the queue is full are
+    dropped and counted instead of blocking the caller.
+    """
+    
+    EXCEPTION_FORMATTER = logging.Formatter()
+    
+    def __init__(self, log_queue, sample_rate=1.0):
+        super().__init__(log_queue)
+        self.sample_rate = sample_rate
+        self.dropped = 0
+    
+    def emit(self, record):
+        if getattr(record, 'sampled', False) and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        super().emit(record)
+    
+    def prepare(self, record):
+        # Queue a snapshot: the message is rendered and the fields redacted
+        # now, so the record holds no live arguments, field values or
+        # traceback frames while it waits for the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self.EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        record.fields = redact(getattr(record, 'fields', None) or {})
+        record.fields_redacted = True
+        return record
+    
+    def enqueue(self, record):
+        if LOG_LISTENER is None:
+            start_log_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+log = logging.getLogger('virtual_partner')
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(StructuredFormatter(json_lines=LOG_FORMAT == 'json'))
+LOG_HANDLER = BackgroundQueueHandler(queue.Queue(LOG_QUEUE_SIZE), LOG_SAMPLE_RATE)
+LOG_LISTENER = None
+LOG_LISTENER_LOCK = threading.Lock()
+
+
+def start_log_listener():
+    """Start this process's writer thread, unless it is already running"""
+    global LOG_LISTENER
+    with LOG_LISTENER_LOCK:
+        if LOG_LISTENER is None:
+            LOG_LISTENER = logging.handlers.QueueListener(LOG_HANDLER.queue, _log_output)
+            LOG_LISTENER.start()
+
+
+def reset_log_listener():
+    """Drop the parent's writer thread in a forked child
+    
+    Threads don't survive fork. The queue and lock are replaced in case the
+    parent's writer held them at the moment of the fork, and the child's
+    writer only starts with its first record, so children that never log
+    (like the password hashing processes) never start one.
+    """
+    global LOG_LISTENER, LOG_LISTENER_LOCK
+    LOG_HANDLER.queue = queue.Queue(LOG_QUEUE_SIZE)
+    LOG_LISTENER = None
+    LOG_LISTENER_LOCK = threading.Lock()
+
+
+def stop_log_listener():
+    """Flush queued records and stop the writer thread at exit"""
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+
+
+start_log_listener()
+os.register_at_fork(after_in_child=reset_log_listener)
+atexit.register(stop_log_listener)
+log.addHandler(LOG_HANDLER)
+
+# When served by gunicorn's gevent worker the standard library is monkey
+# patched; gRPC (used by the Gemini client) needs its own hook to cooperate
+ASYNC_MODE = False
+try:
+    from gevent import monkey
+    ASYNC_MODE = monkey.is_module_patched('socket')
+except ImportError:
+    pass
+if ASYNC_MODE:
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+    log.info("✅ Async mode: gevent workers with cooperative Gemini/Supabase I/O")
+
+app = Flask(__name__)
+CORS(app)
+
+# Behind a reverse proxy (Render, Heroku, nginx) set PROXY_FIX to the number of
+# proxies so request.remote_addr is the real client address
+PROXY_FIX = int(os.getenv('PROXY_FIX', '0'))
+if PROXY_FIX:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX, x_proto=PROXY_FIX)
+
+# Request logging for debugging
+@app.before_request
+def log_request_info():
+    """Log incoming request bodies at DEBUG level (free when disabled)"""
+    if request.path.startswith('/api/') and log.isEnabledFor(logging.DEBUG) and request.is_json:
+        log.debug("📥 %s %s", request.method, request.path, extra=log_fields(body=request.get_json(silent=True)))
+
+
+# Metrics, served in Prometheus text format on /metrics. Recording a value is
+# a lock, a bisect and an increment, so they are always on. Values are per
+# process: with several gunicorn workers each one reports its own.
+def format_labels(names, values):
+    """Render a Prometheus label set like {endpoint="login",stage="password"}"""
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram with fixed bucket bounds and optional labels"""
+    
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}  # label values -> [count per bucket..., count above last bucket, sum]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ['+Inf']
+        with self._lock:
+            for label_values, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(bounds, series):
+                    cumulative += count
+                    labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REQUEST_SECONDS = Histogram('vp_request_seconds', 'Time to produce a response (until headers for streams)', LATENCY_BUCKETS, ('endpoint',))
+REQUESTS_TOTAL = Counter('vp_requests_total', 'Requests handled by endpoint and status code', ('endpoint', 'status'))
+STAGE_SECONDS = Histogram('vp_stage_seconds', 'Time spent in each stage of a request', LATENCY_BUCKETS, ('endpoint', 'stage'))
+GEMINI_TOKENS = Counter('vp_gemini_tokens_total', 'Gemini tokens sent and received (estimated when the SDK reports no usage)', ('direction',))
+HISTORY_MESSAGES = Histogram('vp_history_messages', 'Messages loaded per chat turn or history request', (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000), ('endpoint',))
+
+
+def current_endpoint():
+    """Metrics label for the code running now: the Flask endpoint, or 'background'"""
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+
+# Stage timing: handlers wrap their main steps in timed_stage(). Each stage is
+# recorded in STAGE_SECONDS and the request's totals go out in the
+# Server-Timing header, so load tests and browser dev tools can see where a
+# request's time went
+@contextlib.contextmanager
+def timed_stage(name):
+    """Add the time spent in the block to the current request's stage timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, current_endpoint(), name)
+        if has_request_context():
+            timings = g.setdefault('stage_timings', {})
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+# JSON responses at least this large are gzipped for clients that accept it
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = 6
+
+
+@app.after_request
+def compress_response(response):
+    """Gzip large JSON responses"""
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or not 200 <= response.status_code < 300):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    body = response.get_data()
+    if len(body) >= COMPRESS_MIN_SIZE:
+        response.set_data(gzip.compress(body, COMPRESS_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def server_timing():
+    """The current request's stage timings in Server-Timing form ('' if none)"""
+    return ', '.join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in g.get('stage_timings', {}).items())
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started for REQUEST_SECONDS"""
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Record request metrics and report stage timings in the Server-Timing header"""
+    if 'request_start' in g:
+        endpoint = current_endpoint()
+        elapsed = time.perf_counter() - g.request_start
+        REQUEST_SECONDS.observe(elapsed, endpoint)
+        REQUESTS_TOTAL.inc(endpoint, response.status_code)
+        if request.path.startswith('/api/'):
+            log.info("📥 %s %s %s", request.method, request.path, response.status_code, extra={
+                'sampled': True,
+                'fields': {'ms': round(elapsed * 1000, 1)}
+            })
+    timing = server_timing()
+    if timing:
+        response.headers['Server-Timing'] = timing
+    return response
+
+
+# Supabase Configuration
+SUPABASE_URL = os.getenv('SUPABASE_URL', '')
+SUPABASE_KEY = os.getenv('SUPABASE_KEY', '')
+# Seconds a single Supabase read or write may take before it counts as failed
+SUPABASE_READ_TIMEOUT = float(os.getenv('SUPABASE_READ_TIMEOUT', '3'))
+SUPABASE_WRITE_TIMEOUT = float(os.getenv('SUPABASE_WRITE_TIMEOUT', '10'))
+
+# Supabase client, created by init_supabase() from create_app()
+USE_SUPABASE = False
+supabase = None
+
+
+def init_supabase():
+    """Create the Supabase client (the supabase package is only imported when configured)"""
+    global USE_SUPABASE, supabase
+    if SUPABASE_URL.startswith('fake'):
+        # SUPABASE_URL=fake runs the Supabase backend against FakeSupabaseClient
+        from fake_supabase import FakeSupabaseClient
+        supabase = FakeSupabaseClient(float(os.getenv('FAKE_SUPABASE_LATENCY_MS', '0')))
+        USE_SUPABASE = True
+        log.info("🧪 Fake Supabase client (%gms per request)", supabase.latency * 1000)
+    elif SUPABASE_URL and SUPABASE_KEY:
+        try:
+            from supabase import create_client
+            from supabase.lib.client_options import ClientOptions
+            # The HTTP timeout bounds calls the circuit breaker has stopped waiting for
+            supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(
+                postgrest_client_timeout=max(SUPABASE_READ_TIMEOUT, SUPABASE_WRITE_TIMEOUT)
+            ))
+            USE_SUPABASE = True
+            log.info("✅ Supabase Client Initialized! (connection will be tested on first database operation)")
+        except Exception as e:
+            log.warning("⚠️ Supabase Connection Failed: %s - 📦 using local storage", e, exc_info=True)
+            USE_SUPABASE = False
+            supabase = None
+    else:
+        log.info("⚠️ Supabase credentials not found - 📦 using local storage")
+
+# Local storage, used when Supabase isn't configured (always initialize).
+# LOCAL_STORAGE=sqlite (default) keeps data in an embedded SQLite database
+# that survives restarts and is shared by every worker on the machine;
+# LOCAL_STORAGE=memory keeps everything in process memory.
+class MemoryUserStore:
+    """In-memory user store with O(1) lookups by id and by username"""
+    
+    def __init__(self):
+        self._users = {}  # user_id -> user dict
+        self._ids_by_username = {}  # username -> user_id
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._users)
+    
+    def __contains__(self, user_id):
+        return user_id in self._users
+    
+    def get(self, user_id):
+        """Get a user by id, including its 'id' field"""
+        user = self._users.get(user_id)
+        return {**user, 'id': user_id} if user else None
+    
+    def find_by_username(self, username):
+        """Get a user by username, including its 'id' field"""
+        user_id = self._ids_by_username.get(username)
+        return self.get(user_id) if user_id else None
+    
+    def create(self, user_id, username, **fields):
+        """Add a user; raises ValueError if the username is taken"""
+        with self._lock:
+            if username in self._ids_by_username:
+                raise ValueError("Username already exists")
+            self._users[user_id] = {'username': username, **fields}
+            self._ids_by_username[username] = user_id
+    
+    def update(self, user_id, **fields):
+        """Update fields on an existing user, keeping the username index in sync"""
+        with self._lock:
+            user = self._users[user_id]
+            new_username = fields.get('username')
+            if new_username is not None and new_username != user['username']:
+                if new_username in self._ids_by_username:
+                    raise ValueError("Username already exists")
+                del self._ids_by_username[user['username']]
+                self._ids_by_username[new_username] = user_id
+            user.update(fields)
+            return {**user, 'id': user_id}
+
+
+class MemoryChatStore:
+    """In-memory chat messages and summaries
+    
+    Messages are numbered from seq 1 with no gaps, so seq cursors map
+    straight to list indexes; timestamps are sorted, so `since` is a bisect.
+    """
+    
+    def __init__(self):
+        self._messages = {}  # user_id -> list of messages, in seq order
+        self._summaries = {}  # user_id -> {'summary', 'through_seq'}
+        self._indexes = {}  # user_id -> MessageIndex
+    
+    def get_messages(self, user_id, limit=None):
+        """Get a user's messages, optionally only the newest `limit`"""
+        messages = self._messages.get(user_id, [])
+        if limit is not None:
+            return messages[-limit:]
+        return list(messages)
+    
+    def append(self, user_id, messages):
+        """Append messages for a user and add them to the search index"""
+        self._messages.setdefault(user_id, []).extend(messages)
+        index = self._indexes.setdefault(user_id, MessageIndex())
+        for msg in messages:
+            if not is_connection_noise(msg):
+                index.add(msg['seq'], msg['content'])
+    
+    def search(self, user_id, terms, limit=20, offset=0):
+        """Get up to limit + 1 ranked search hits; see StorageBackend.search_messages"""
+        index = self._indexes.get(user_id)
+        if index is None:
+            return []
+        messages = self._messages[user_id]
+        return [
+            {
+                "seq": seq,
+                "role": messages[seq - 1]['role'],
+                "timestamp": messages[seq - 1]['timestamp'],
+                "snippet": make_snippet(messages[seq - 1]['content'], terms)
+            }
+            for seq in index.search(terms)[offset:offset + limit + 1]
+        ]
+    
+    def last_seq(self, user_id):
+        """Seq of a user's newest message (0 if none)"""
+        messages = self._messages.get(user_id)
+        return messages[-1]['seq'] if messages else 0
+    
+    def get_page(self, user_id, before=None, after=None, since=None, limit=50):
+        """Get up to limit + 1 messages around a cursor; see StorageBackend.get_messages_page"""
+        messages = self._messages.get(user_id, [])
+        if since is not None:
+            start = bisect.bisect_right(messages, since, key=lambda m: m['timestamp'])
+            return messages[start:start + limit + 1]
+        if after is not None:
+            return messages[after:after + limit + 1]
+        end = len(messages) if before is None else max(0, min(before - 1, len(messages)))
+        return messages[max(0, end - limit - 1):end]
+    
+    def get_summary(self, user_id):
+        """Get a chat's rolling summary (empty if none)"""
+        return self._summaries.get(user_id, {})
+    
+    def save_summary(self, user_id, summary, through_seq):
+        """Save a chat's rolling summary"""
+        self._summaries[user_id] = {'summary': summary, 'through_seq': through_seq}
+
+
+class SQLiteDatabase:
+    """Embedded SQLite database in WAL mode with one connection per thread
+    
+    WAL lets readers run alongside a writer, so several gunicorn workers on
+    one machine can share the file. sqlite3 caches the prepared form of each
+    parameterized statement per connection, so repeated queries skip parsing.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            gender TEXT DEFAULT 'other',
+            bot_name TEXT DEFAULT 'Virtual Partner',
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            connection_noise INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS chat_messages_user_time ON chat_messages (user_id, timestamp);
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            through_seq INTEGER NOT NULL,
+            updated_at TEXT
+        );
+        -- Search index, kept up to date by the trigger. user_id is indexed
+        -- too, so a search only intersects that user's posting lists.
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+            content, user_id, seq UNINDEXED
+        );
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages
+        WHEN NOT NEW.connection_noise BEGIN
+            INSERT INTO chat_messages_fts (content, user_id, seq) VALUES (NEW.content, NEW.user_id, NEW.seq);
+        END;
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # One write transaction, so workers starting together can't both
+        # backfill the search index. It only starts out empty when it was just
+        # created: after that, every indexable message is added by the trigger.
+        with self.connection() as conn:
+            conn.executescript(
+                "BEGIN IMMEDIATE;" + self.SCHEMA +
+                "INSERT INTO chat_messages_fts (content, user_id, seq) "
+                "SELECT content, user_id, seq FROM chat_messages "
+                "WHERE NOT connection_noise AND NOT EXISTS (SELECT 1 FROM chat_messages_fts);"
+                "COMMIT;"
+            )
+    
+    def connection(self):
+        """Return this thread's connection, opening it on first use
+        
+        Connections are never shared with a forked child: a thread that
+        carried one across a fork opens a new one.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints; safe with WAL
+            conn.execute("PRAGMA busy_timeout=5000")  # Wait for other workers' writes instead of failing
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    def query(self, sql, params=()):
+        """Run a read query and return rows as dicts"""
+        return [dict(row) for row in self.connection().execute(sql, params)]
+    
+    def execute(self, sql, params=()):
+        """Run a single write statement in its own transaction"""
+        with self.connection() as conn:
+            return conn.execute(sql, params)
+
+
+class SQLiteUserStore:
+    """User store backed by SQLite, with the same interface as MemoryUserStore"""
+    
+    COLUMNS = ('username', 'password', 'gender', 'bot_name', 'created_at')
+    
+    def __init__(self, db):
+        self.db = db
+    
+    def __len__(self):
+        return self.db.query("SELECT COUNT(*) AS n FROM users")[0]['n']
+    
+    def __contains__(self, user_id):
+        return bool(self.db.query("SELECT 1 FROM users WHERE id = ?", (user_id,)))
+    
+    def get(self, user_id):
+        """Get a user by id, including its 'id' field"""
+        rows = self.db.query("SELECT * FROM users WHERE id = ?", (user_id,))
+        return rows[0] if rows else None
+    
+    def find_by_username(self, username):
+        """Get a user by username, including its 'id' field"""
+        rows = self.db.query("SELECT * FROM users WHERE username = ?", (username,))
+        return rows[0] if rows else None
+    
+    def create(self, user_id, username, **fields):
+        """Add a user; raises ValueError if the username is taken"""
+        fields = {key: value for key, value in fields.items() if key in self.COLUMNS}
+        columns = ['id', 'username'] + list(fields)
+        try:
+            self.db.execute(
+                f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                (user_id, username, *fields.values())
+            )
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+    
+    def update(self, user_id, **fields):
+        """Update fields on an existing user"""
+        fields = {key: value for key, value in fields.items() if key in self.COLUMNS}
+        if fields:
+            try:
+                cursor = self.db.execute(
+                    f"UPDATE users SET {', '.join(f'{key} = ?' for key in fields)} WHERE id = ?",
+                    (*fields.values(), user_id)
+                )
+            except sqlite3.IntegrityError:
+                raise ValueError("Username already exists")
+            if cursor.rowcount == 0:
+                raise KeyError(user_id)
+        return self.get(user_id)
+
+
+class SQLiteChatStore:
+    """Chat messages and summaries backed by SQLite, with the same interface as MemoryChatStore"""
+    
+    MESSAGE_COLUMNS = "seq, role, content, timestamp, connection_noise"
+    
+    def __init__(self, db):
+        self.db = db
+    
+    def _messages(self, sql, params):
+        rows = self.db.query(sql, params)
+        for row in rows:
+            row['connection_noise'] = bool(row['connection_noise'])
+        return rows
+    
+    def get_messages(self, user_id, limit=None):
+        """Get a user's messages, optionally only the newest `limit`"""
+        if limit is None:
+            return self._messages(
+                f"SELECT {self.MESSAGE_COLUMNS} FROM chat_messages WHERE user_id = ? ORDER BY seq",
+                (user_id,)
+            )
+        rows = self._messages(
+            f"SELECT {self.MESSAGE_COLUMNS} FROM chat_messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, limit)
+        )
+        rows.reverse()
+        return rows
+    
+    def append(self, user_id, messages):
+        """Append messages for a user in one transaction
+        
+        Seqs are settled inside the transaction: if another worker appended
+        to the chat after these messages were numbered, they are renumbered
+        to follow the newest stored message (the dicts are updated in place).
+        """
+        conn = self.db.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            last_seq = conn.execute("SELECT MAX(seq) FROM chat_messages WHERE user_id = ?", (user_id,)).fetchone()[0] or 0
+            if messages and messages[0]['seq'] <= last_seq:
+                for seq, msg in enumerate(messages, start=last_seq + 1):
+                    msg['seq'] = seq
+            conn.executemany(
+                "INSERT INTO chat_messages (user_id, seq, role, content, timestamp, connection_noise) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(user_id, msg['seq'], msg['role'], msg['content'], msg['timestamp'],
+                  int(bool(msg.get('connection_noise')))) for msg in messages]
+            )
+    
+    def last_seq(self, user_id):
+        """Seq of a user's newest message (0 if none), read from the primary key index"""
+        rows = self.db.query("SELECT MAX(seq) AS seq FROM chat_messages WHERE user_id = ?", (user_id,))
+        return rows[0]['seq'] or 0
+    
+    def get_page(self, user_id, before=None, after=None, since=None, limit=50):
+        """Get up to limit + 1 messages around a cursor; see StorageBackend.get_messages_page"""
+        if since is not None:
+            return self._messages(
+                f"SELECT {self.MESSAGE_COLUMNS} FROM chat_messages WHERE user_id = ? AND timestamp > ? "
+                "ORDER BY seq LIMIT ?",
+                (user_id, since, limit + 1)
+            )
+        if after is not None:
+            return self._messages(
+                f"SELECT {self.MESSAGE_COLUMNS} FROM chat_messages WHERE user_id = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?",
+                (user_id, after, limit + 1)
+            )
+        rows = self._messages(
+            f"SELECT {self.MESSAGE_COLUMNS} FROM chat_messages WHERE user_id = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (user_id, before if before is not None else 2 ** 62, limit + 1)
+        )
+        rows.reverse()
+        return rows
+    
+    def search(self, user_id, terms, limit=20, offset=0):
+        """Get up to limit + 1 ranked search hits; see StorageBackend.search_messages"""
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += '*'
+        match = f'user_id : "{user_id.replace(chr(34), chr(34) * 2)}" AND content : ({" ".join(quoted)})'
+        return self.db.query(
+            "SELECT m.seq, m.role, m.timestamp, "
+            f"snippet(chat_messages_fts, 0, '{SNIPPET_MARK}', '{SNIPPET_MARK}', '…', {SNIPPET_WORDS}) AS snippet "
+            "FROM chat_messages_fts JOIN chat_messages m ON m.user_id = chat_messages_fts.user_id "
+            "AND m.seq = chat_messages_fts.seq "
+            "WHERE chat_messages_fts MATCH ? "
+            "ORDER BY bm25(chat_messages_fts, 1.0, 0.0), m.seq DESC LIMIT ? OFFSET ?",
+            (match, limit + 1, offset)
+        )
+    
+    def get_summary(self, user_id):
+        """Get a chat's rolling summary (empty if none)"""
+        rows = self.db.query("SELECT summary, through_seq FROM chat_summaries WHERE user_id = ?", (user_id,))
+        return rows[0] if rows else {}
+    
+    def save_summary(self, user_id, summary, through_seq):
+        """Save a chat's rolling summary"""
+        self.db.execute(
+            "INSERT INTO chat_summaries (user_id, summary, through_seq, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary, "
+            "through_seq = excluded.through_seq, updated_at = excluded.updated_at",
+            (user_id, summary, through_seq, datetime.now(timezone.utc).isoformat())
+        )
+
+
+LOCAL_STORAGE = os.getenv('LOCAL_STORAGE', 'sqlite').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'virtual_partner.db')
+LOCAL_STORAGE_NAMES = {'memory': 'In-Memory', 'sqlite': 'SQLite'}
+if LOCAL_STORAGE != 'memory':
+    LOCAL_STORAGE = 'sqlite'
+
+
+# Gemini Configuration
+# The SDK (and gRPC under it) is the slowest import in the app, so it is
+# loaded by init_gemini() from create_app() rather than at import time
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
+genai = None
+
+
+def init_gemini():
+    """Import and configure the Gemini SDK"""
+    global genai, GEMINI_API_KEY, SUPPORTS_SYSTEM_INSTRUCTION
+    import google.generativeai as genai
+    # google-generativeai 0.5+ accepts the system prompt as a model-level
+    # system_instruction; older SDKs need it sent as part of every prompt
+    SUPPORTS_SYSTEM_INSTRUCTION = 'system_instruction' in inspect.signature(genai.GenerativeModel.__init__).parameters
+    if GEMINI_API_KEY:
+        try:
+            genai.configure(api_key=GEMINI_API_KEY)
+            log.info("✅ Gemini API Connected!")
+        except Exception as e:
+            log.warning("⚠️ Gemini API Configuration Error: %s", e)
+            GEMINI_API_KEY = ''  # Reset if configuration fails
+    else:
+        log.warning("⚠️ Gemini API key not found - app will start but AI features may not work")
+
+# Base system prompt template
+def get_system_prompt(user_gender, bot_name):
+    """Generate gender-aware system prompt based on user's gender (opposite)"""
+    # Determine bot's gender (opposite of user)
+    # If user is male, bot is female; if user is female, bot is male; if user is other, bot is female
+    if user_gender == "male":
+        bot_gender = "female"
+    elif user_gender == "female":
+        bot_gender = "male"
+    else:  # other
+        bot_gender = "female"  # Default to female for variety
+    
+    gender_pronouns = "she/her" if bot_gender == "female" else "he/him"
+    gender_identity = "woman" if bot_gender == "female" else "man"
+    
+    return f"""You are {bot_name}, a caring, empathetic virtual partner. You are a {gender_identity} ({gender_pronouns}).
+
+CRITICAL RESPONSE GUIDELINES:
+- Match the user's message length and energy level. Short messages get short responses. Long messages can get longer responses.
+- Be natural and conversational, like texting with a close friend
+- Keep responses brief and human-like (1-3 sentences for short messages, max 2-3 sentences for longer topics)
+- Use casual, everyday language - avoid formal or overly structured responses
+- Use emojis sparingly (1-2 max per message, only when natural)
+- Don't over-explain or repeat yourself
+- Respond with genuine care, but keep it concise and real
+
+CONVERSATION STYLE:
+- If user says "hi" or "hey" → respond with a brief friendly greeting (1 sentence)
+- If user asks a question → answer directly and briefly
+- If user shares something personal → acknowledge briefly, show you care, maybe ask one short follow-up
+- Match the tone: casual for casual, serious for serious
+- Be supportive but don't be preachy or give long advice unless asked
+
+REMEMBER:
+- You are {bot_name} - use your name naturally if it comes up, but don't force it
+- Ignore old messages about connection issues
+- Focus on the current conversation
+- Keep it REAL and HUMAN - avoid sounding like a chatbot"""
+
+
+# Assistant messages about old connection problems are noise in later prompts.
+# One precompiled pattern covers the known phrases plus the word combinations
+# ("connection" + "better", "connected" + "checking", ...) that signal them.
+CONNECTION_PHRASES = [
+    "connection failed", "connection issues", "connection problem",
+    "connection error", "are now connected", "connection is better",
+    "connection working", "connection stable", "checking if the connection",
+    "connection working better", "no, are now connected"
+]
+CONNECTION_NOISE_RE = re.compile(
+    "|".join(re.escape(phrase) for phrase in CONNECTION_PHRASES)
+    + r"|^(?=.*connection)(?=.*better)"
+    + r"|^(?=.*connected)(?=.*checking)"
+    + r"|^(?=.*connection)(?=.*still)(?=.*checking)",
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def is_connection_message(content):
+    """Check whether an assistant message is primarily about connection issues"""
+    return CONNECTION_NOISE_RE.search(content) is not None
+
+
+def is_connection_noise(msg):
+    """Check a stored message, using the flag saved at write time when present"""
+    if msg.get('role') != 'assistant':
+        return False
+    if 'connection_noise' in msg:
+        return msg['connection_noise']
+    return is_connection_message(msg.get('content', ''))
+
+
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+# Set by init_gemini()
+SUPPORTS_SYSTEM_INSTRUCTION = False
+
+
+@functools.lru_cache(maxsize=256)
+def get_persona(user_gender, bot_name):
+    """Return (system_prompt, model) for a persona, built once and reused across turns"""
+    system_prompt = get_system_prompt(user_gender, bot_name)
+    if SUPPORTS_SYSTEM_INSTRUCTION:
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_prompt)
+    else:
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return system_prompt, model
+
+
+@functools.lru_cache(maxsize=None)
+def get_generation_config(max_tokens):
+    """Return the (shared) generation config for a response length"""
+    return genai.types.GenerationConfig(
+        temperature=0.7,  # Slightly lower for more consistent, natural responses
+        max_output_tokens=max_tokens,
+        top_p=0.9,
+        top_k=40
+    )
+
+
+# Context window: newest messages are packed into a token budget, and older
+# turns are folded into a rolling summary that is stored with the chat
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1200'))
+# Cap on unsummarized messages, kept below CHAT_TAIL_SIZE so every message is
+# still loaded when it is folded into the summary
+CONTEXT_MAX_MESSAGES = int(os.getenv('CONTEXT_MAX_MESSAGES', '16'))
+SUMMARY_MAX_TOKENS = 250
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token) for budgeting prompts"""
+    return len(text) // 4 + 1
+
+
+def record_gemini_tokens(response, prompt, reply):
+    """Count a call's tokens, from the SDK's usage metadata when it has any"""
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    reply_tokens = getattr(usage, 'candidates_token_count', None)
+    GEMINI_TOKENS.inc('in', amount=prompt_tokens if prompt_tokens else estimate_tokens(prompt))
+    GEMINI_TOKENS.inc('out', amount=reply_tokens if reply_tokens else estimate_tokens(reply))
+
+
+def select_context_window(history, summarized_through=0, budget=CONTEXT_TOKEN_BUDGET):
+    """Pick the newest unsummarized messages that fit in the token budget, oldest first
+    
+    Connection-noise messages are skipped; only messages up to the point the
+    budget runs out are ever looked at.
+    """
+    window = []
+    used = 0
+    for msg in reversed(history):
+        if msg.get('seq', summarized_through + 1) <= summarized_through:
+            break
+        if is_connection_noise(msg):
+            continue
+        cost = estimate_tokens(msg['content'])
+        if window and used + cost > budget:
+            break
+        window.append(msg)
+        used += cost
+    window.reverse()
+    return window
+
+
+def messages_to_fold(history, summarized_through=0):
+    """Return the oldest unsummarized messages that should move into the summary
+    
+    Nothing is folded until the unsummarized messages overflow the token budget
+    or CONTEXT_MAX_MESSAGES. Then enough are folded to bring them back to half
+    of both limits, so the summary is only recomputed every few turns.
+    """
+    pending = [msg for msg in history if msg.get('seq', 0) > summarized_through]
+    costs = [estimate_tokens(msg['content']) for msg in pending]
+    total = sum(costs)
+    if total <= CONTEXT_TOKEN_BUDGET and len(pending) <= CONTEXT_MAX_MESSAGES:
+        return []
+    
+    fold_count = 0
+    while fold_count < len(pending) and (
+        total > CONTEXT_TOKEN_BUDGET // 2 or len(pending) - fold_count > CONTEXT_MAX_MESSAGES // 2
+    ):
+        total -= costs[fold_count]
+        fold_count += 1
+    return pending[:fold_count]
+
+
+@functools.lru_cache(maxsize=None)
+def get_summary_model():
+    """Return the shared model used to maintain conversation summaries"""
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def update_conversation_summary(user_id, bot_name, summary, folded):
+    """Fold messages into the rolling summary with Gemini and save it"""
+    lines = []
+    for msg in folded:
+        role = "User" if msg["role"] == "user" else bot_name
+        lines.append(f"{role}: {msg['content']}")
+    
+    prompt = (
+        f"You maintain a running summary of a conversation between a user and {bot_name}. "
+        "Update the summary with the new messages. Keep facts about the user, their feelings, "
+        "plans and anything they would expect to be remembered. Write at most 150 words.\n\n"
+        f"Current summary:\n{summary.get('summary') or '(none)'}\n\n"
+        "New messages:\n" + "\n".join(lines) + "\n\nUpdated summary:"
+    )
+    response = GEMINI_SCHEDULER.call(user_id, lambda: get_summary_model().generate_content(
+        prompt,
+        generation_config=get_generation_config(SUMMARY_MAX_TOKENS)
+    ), timeout=GEMINI_TIMEOUT)
+    record_gemini_tokens(response, prompt, response.text)
+    STORAGE.save_summary(user_id, response.text.strip(), folded[-1]['seq'])
+    log.info("🧠 Folded %d messages into summary", len(folded), extra=log_fields(user_id=user_id))
+
+
+def load_unsummarized(user_id, summarized_through, conversation_history):
+    """Return the messages after summarized_through, loading any the history tail doesn't reach
+    
+    The tail a turn loads is only CHAT_TAIL_SIZE long, so after summaries have
+    failed for a while (or for an imported chat) it starts past the summary.
+    The gap is read from storage, at most CHAT_TAIL_SIZE messages at a time.
+    """
+    if not conversation_history or conversation_history[0].get('seq', 0) <= summarized_through + 1:
+        return conversation_history
+    backlog = STORAGE.get_messages_page(user_id, after=summarized_through, limit=CHAT_TAIL_SIZE)[:CHAT_TAIL_SIZE]
+    if not backlog:
+        return conversation_history
+    last_seq = backlog[-1]['seq']
+    return backlog + [msg for msg in conversation_history if msg.get('seq', 0) > last_seq]
+
+
+SUMMARIES_IN_PROGRESS = set()
+SUMMARIES_LOCK = threading.Lock()
+# After a failed summary a chat waits before trying again, doubling up to the
+# cap, so a Gemini outage doesn't start a summary call on every turn
+SUMMARY_RETRY_SECONDS = float(os.getenv('SUMMARY_RETRY_SECONDS', '30'))
+SUMMARY_RETRY_MAX_SECONDS = 600.0
+SUMMARY_FAILURES = {}  # user_id -> (consecutive failures, monotonic time of next attempt)
+
+
+def maybe_update_summary(user_id, bot_name, summary, conversation_history):
+    """Fold old messages into the summary in the background once they overflow the window"""
+    if not GEMINI_API_KEY:
+        return
+    through_seq = summary.get('through_seq', 0)
+    if not messages_to_fold(conversation_history, through_seq):
+        return
+    
+    with SUMMARIES_LOCK:
+        if user_id in SUMMARIES_IN_PROGRESS:
+            return
+        failure = SUMMARY_FAILURES.get(user_id)
+        if failure and time.monotonic() < failure[1]:
+            return
+        SUMMARIES_IN_PROGRESS.add(user_id)
+    
+    def run():
+        try:
+            with timed_stage('summary'):
+                history = load_unsummarized(user_id, through_seq, conversation_history)
+                folded = messages_to_fold(history, through_seq)[:CHAT_TAIL_SIZE]
+                if folded:
+                    update_conversation_summary(user_id, bot_name, summary, folded)
+            with SUMMARIES_LOCK:
+                SUMMARY_FAILURES.pop(user_id, None)
+        except Exception as e:
+            with SUMMARIES_LOCK:
+                failures = SUMMARY_FAILURES.get(user_id, (0, 0))[0] + 1
+                delay = min(SUMMARY_RETRY_SECONDS * (2 ** (failures - 1)), SUMMARY_RETRY_MAX_SECONDS)
+                SUMMARY_FAILURES[user_id] = (failures, time.monotonic() + delay)
+            log.error("Summary Error: %s (retrying in %.0fs)", e, delay, exc_info=True, extra=log_fields(user_id=user_id))
+        finally:
+            with SUMMARIES_LOCK:
+                SUMMARIES_IN_PROGRESS.discard(user_id)
+    
+    threading.Thread(target=run, daemon=True).start()
+
+
+def build_ai_request(user_message, conversation_history, user_gender="other", bot_name="Virtual Partner", summary=None):
+    """Build the model, prompt context and generation config for a chat turn
+    
+    `conversation_history` ends with the current user message, which is added
+    to the prompt separately. `summary` is the chat's rolling summary, if any.
+    """
+    summary = summary or {}
+    history = conversation_history
+    if history and history[-1].get('role') == 'user' and history[-1].get('content') == user_message:
+        history = history[:-1]
+    
+    # Get the cached gender-aware system prompt and model
+    system_prompt, model = get_persona(user_gender, bot_name)
+    
+    # Determine response length based on user message
+    user_msg_length = len(user_message.split())
+    if user_msg_length <= 5:  # Very short (hi, hey, thanks, etc.)
+        max_tokens = 50  # Keep responses very short
+        response_instruction = "Keep your response VERY brief - 1 short sentence max."
+    elif user_msg_length <= 15:  # Short message
+        max_tokens = 100  # Short response
+        response_instruction = "Keep your response brief - 1-2 sentences."
+    elif user_msg_length <= 50:  # Medium message
+        max_tokens = 200  # Medium response
+        response_instruction = "Keep your response concise - 2-3 sentences."
+    else:  # Long message
+        max_tokens = 300  # Can be longer but still concise
+        response_instruction = "Respond naturally but keep it concise - 2-4 sentences max."
+    
+    # Build conversation context (the system prompt travels with the model when supported)
+    parts = [] if SUPPORTS_SYSTEM_INSTRUCTION else [system_prompt, "\n\n"]
+    if summary.get('summary'):
+        parts.append(f"Summary of your earlier conversation:\n{summary['summary']}\n\n")
+    parts.append(response_instruction + "\n\nConversation:\n")
+    
+    # Add the newest messages that fit in the token budget
+    window = select_context_window(history, summary.get('through_seq', 0))
+    for msg in window:
+        role = "User" if msg["role"] == "user" else bot_name
+        parts.append(f"{role}: {msg['content']}\n")
+    
+    parts.append(f"User: {user_message}\n{bot_name}:")
+    context = ''.join(parts)
+    
+    log.debug("🤖 Generating AI response", extra=log_fields(
+        user_message=user_message, gender=user_gender, bot_name=bot_name, max_tokens=max_tokens
+    ))
+    
+    return model, context, get_generation_config(max_tokens), user_msg_length
+
+
+# Gemini request scheduling
+class GeminiBusyError(Exception):
+    """Raised when a Gemini request can't be served within its deadline"""
+
+
+RATE_LIMITED_MESSAGE = "Too many requests right now 😅 Try again in a moment!"
+
+
+def is_retryable_ai_error(e):
+    """Check whether a Gemini error is a rate limit or transient server error"""
+    code = getattr(e, 'code', None)
+    if isinstance(code, int) and (code == 429 or code >= 500):
+        return True
+    text = str(e)
+    return "429" in text or "Resource exhausted" in text or "503" in text or "500" in text
+
+
+class GeminiScheduler:
+    """Shared gate in front of generate_content
+    
+    A token bucket holds requests to the configured rate. Callers that have
+    to wait queue up per user and tokens are handed out round-robin across
+    users, so one chatty user can't starve the rest. The queue is bounded and
+    every wait has a deadline. 429s and 5xx errors are retried with jittered
+    exponential backoff; a 429 also empties the bucket since the quota is
+    shared by every request.
+    """
+    
+    def __init__(self, rate_per_minute=15, burst=5, max_queue=50, max_retries=3, base_backoff=1.0):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.rate_limited = 0
+        self.rejected = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters = OrderedDict()  # user key -> deque of waiter ids, in round-robin order
+        self._queued = 0
+        self._cond = threading.Condition()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self, user_key, deadline):
+        """Wait for a request slot; raises GeminiBusyError if the queue is full or the deadline passes"""
+        waiter = object()
+        with self._cond:
+            self._refill()
+            if not self._waiters and self._tokens >= 1:
+                self._tokens -= 1
+                return
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise GeminiBusyError("Gemini request queue is full")
+            self._waiters.setdefault(user_key, deque()).append(waiter)
+            self._queued += 1
+            try:
+                while True:
+                    self._refill()
+                    head_key = next(iter(self._waiters))
+                    if self._tokens >= 1 and head_key == user_key and self._waiters[user_key][0] is waiter:
+                        self._tokens -= 1
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise GeminiBusyError("Timed out waiting for a Gemini request slot")
+                    wait_for_token = max((1 - self._tokens) / self.rate, 0.01)
+                    self._cond.wait(min(remaining, wait_for_token))
+            finally:
+                # Leave the queue and rotate this user to the back for fairness
+                queue = self._waiters[user_key]
+                queue.remove(waiter)
+                del self._waiters[user_key]
+                if queue:
+                    self._waiters[user_key] = queue
+                self._queued -= 1
+                self._cond.notify_all()
+    
+    def call(self, user_key, fn, timeout=20.0):
+        """Run fn() once a slot is free, retrying rate limits and server errors"""
+        deadline = time.monotonic() + timeout
+        for attempt in range(self.max_retries + 1):
+            self.acquire(user_key, deadline)
+            try:
+                return fn()
+            except Exception as e:
+                rate_limited = getattr(e, 'code', None) == 429 or "429" in str(e) or "Resource exhausted" in str(e)
+                if rate_limited:
+                    self.rate_limited += 1
+                if not is_retryable_ai_error(e) or attempt == self.max_retries:
+                    raise
+                if rate_limited:
+                    with self._cond:
+                        self._tokens = 0.0
+                        self._updated = time.monotonic()
+                delay = random.uniform(0, self.base_backoff * (2 ** attempt))
+                if time.monotonic() + delay > deadline:
+                    raise GeminiBusyError(f"Gemini still unavailable after {attempt + 1} attempts: {e}") from e
+                log.warning("⏳ Gemini error (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+    
+    def stats(self):
+        """Queue depth and counters for /api/health"""
+        with self._cond:
+            self._refill()
+            return {
+                "queued": self._queued,
+                "tokens": round(self._tokens, 2),
+                "rate_limited": self.rate_limited,
+                "rejected": self.rejected
+            }
+
+
+GEMINI_SCHEDULER = GeminiScheduler(
+    rate_per_minute=float(os.getenv('GEMINI_RPM', '15')),
+    burst=int(os.getenv('GEMINI_BURST', '5')),
+    max_queue=int(os.getenv('GEMINI_QUEUE_SIZE', '50'))
+)
+# Longest a chat turn waits for Gemini, including queueing and retries
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '30'))
+
+
+def get_ai_error_message(e):
+    """Log an AI error and return the user-facing fallback text"""
+    log.error("AI Error: %s", e, exc_info=True)
+    
+    # Check for rate limiting
+    if "429" in str(e) or "Resource exhausted" in str(e):
+        return RATE_LIMITED_MESSAGE
+    
+    return f"Something went wrong. Can you try again?"
+
+
+def get_ai_response(user_message, conversation_history, user_gender="other", bot_name="Virtual Partner", summary=None, user_id=None):
+    """Get response from Gemini API with gender-aware context
+    
+    Raises GeminiBusyError if Gemini stays rate limited past GEMINI_TIMEOUT,
+    so the caller can fail the turn instead of saving an error as a reply.
+    """
+    if not GEMINI_API_KEY:
+        return f"I'm sorry, but I'm not properly configured right now. Please check the server configuration. 😔"
+    
+    try:
+        with timed_stage('prompt'):
+            model, context, generation_config, user_msg_length = build_ai_request(
+                user_message, conversation_history, user_gender, bot_name, summary
+            )
+        
+        with timed_stage('gemini'):
+            response = GEMINI_SCHEDULER.call(user_id, lambda: model.generate_content(
+                context,
+                generation_config=generation_config
+            ), timeout=GEMINI_TIMEOUT)
+        
+        response_text = response.text.strip()
+        record_gemini_tokens(response, context, response_text)
+        
+        # Post-process: if response is still too long for short messages, truncate it
+        if user_msg_length <= 5 and len(response_text.split()) > 15:
+            # For very short user messages, force shorter response
+            sentences = response_text.split('. ')
+            response_text = '. '.join(sentences[:1])
+            if not response_text.endswith('.') and not response_text.endswith('!') and not response_text.endswith('?'):
+                response_text += '.'
+        
+        log.debug("✅ AI Response", extra=log_fields(response=response_text))
+        return response_text
+    
+    except GeminiBusyError:
+        raise
+    except Exception as e:
+        if is_retryable_ai_error(e):
+            log.warning("AI Error: %s", e)
+            raise GeminiBusyError(str(e)) from e
+        return get_ai_error_message(e)
+
+
+def stream_ai_response(user_message, conversation_history, user_gender="other", bot_name="Virtual Partner", summary=None, user_id=None):
+    """Yield response text chunks from Gemini as they are generated
+    
+    Streamed text is forwarded as-is, so the short-message truncation done in
+    get_ai_response is not applied here; the prompt's length instruction and
+    max_output_tokens bound the reply instead. Like get_ai_response, raises
+    GeminiBusyError (before any text is sent) when Gemini stays rate limited.
+    """
+    if not GEMINI_API_KEY:
+        yield f"I'm sorry, but I'm not properly configured right now. Please check the server configuration. 😔"
+        return
+    
+    sent_any = False
+    try:
+        with timed_stage('prompt'):
+            model, context, generation_config, _ = build_ai_request(
+                user_message, conversation_history, user_gender, bot_name, summary
+            )
+        
+        # Includes the time the client takes to read each chunk
+        with timed_stage('gemini'):
+            response = GEMINI_SCHEDULER.call(user_id, lambda: model.generate_content(
+                context,
+                generation_config=generation_config,
+                stream=True
+            ), timeout=GEMINI_TIMEOUT)
+            
+            reply = []
+            for chunk in response:
+                text = chunk.text
+                if not text:
+                    continue
+                if not sent_any:
+                    # Drop leading whitespace the model sometimes emits before the reply
+                    text = text.lstrip()
+                    if not text:
+                        continue
+                sent_any = True
+                reply.append(text)
+                yield text
+        
+        record_gemini_tokens(response, context, ''.join(reply))
+        log.debug("✅ AI Response streamed")
+    
+    except GeminiBusyError:
+        raise
+    except Exception as e:
+        if not sent_any and is_retryable_ai_error(e):
+            log.warning("AI Error: %s", e)
+            raise GeminiBusyError(str(e)) from e
+        error_text = get_ai_error_message(e)
+        # Keep partial output if the stream broke midway, otherwise send the fallback
+        if not sent_any:
+            yield error_text
+
+
+def sse_event(event, data):
+    """Format a single Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Session tokens
+# login and register hand out a signed, expiring token carrying the user id and
+# persona. Clients send it back as "Authorization: Bearer <token>", so a chat
+# turn needs no user lookup and a request can only act for its own user.
+# Profile updates return a fresh token with the new persona.
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(7 * 24 * 3600)))
+SESSION_SECRET = os.getenv('SESSION_SECRET', '')
+
+
+# Only a single local process may make up its own key: `python app.py` or a
+# development server. Anywhere else several workers (gunicorn without
+# preload, or more than one machine) would each sign with a different key.
+DEV_SERVER = __name__ == '__main__' or os.getenv('FLASK_ENV') == 'development' or \
+    os.getenv('FLASK_DEBUG', '').lower() in ('1', 'true')
+
+if not SESSION_SECRET:
+    # A key shared by several processes must come from the operator: anything
+    # derived from other credentials (the Supabase anon key is public) would
+    # let whoever knows them sign tokens for any user
+    if not DEV_SERVER:
+        raise RuntimeError("SESSION_SECRET must be set (only `python app.py` and development runs may omit it)")
+    SESSION_SECRET = secrets.token_hex(32)
+    log.warning("⚠️ SESSION_SECRET not set - using a random key; sessions won't survive a restart")
+SESSION_SERIALIZER = URLSafeTimedSerializer(SESSION_SECRET, salt='session')
+
+
+def issue_session_token(user_id, gender, bot_name):
+    """Sign a session token for a user and their current persona"""
+    return SESSION_SERIALIZER.dumps({
+        "uid": str(user_id),
+        "gender": gender or 'other',
+        "bot_name": bot_name or 'Virtual Partner'
+    })
+
+
+def read_session_token():
+    """Get the verified session from the Authorization header, or None if missing, invalid or expired"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    try:
+        return SESSION_SERIALIZER.loads(token.strip(), max_age=SESSION_TTL)
+    except BadSignature:
+        return None
+
+
+def session_error(session, user_id=None):
+    """Error response when there is no valid session or it belongs to another user"""
+    if session is None:
+        return jsonify({"error": "Please log in again"}), 401
+    if user_id is not None and str(user_id) != session['uid']:
+        return jsonify({"error": "Not allowed for this user"}), 403
+    return None
+
+
+# Chat Message Storage
+# Each message is stored as its own record keyed by (user_id, seq), so a turn
+# only appends two records and reads the tail it needs instead of rewriting
+# the whole conversation.
+
+# Number of recent messages loaded for a chat turn; a little above
+# CONTEXT_MAX_MESSAGES so unsummarized messages are always in the tail
+CHAT_TAIL_SIZE = CONTEXT_MAX_MESSAGES + 4
+# Supabase returns at most 1000 rows per request
+SUPABASE_PAGE_SIZE = 1000
+# Page sizes for /api/chat/history
+DEFAULT_HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+# Page sizes and query limits for /api/chat/search
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_TERMS = 10
+
+def message_row(user_id, msg):
+    """Convert a message dict into a chat_messages row"""
+    return {
+        "user_id": user_id,
+        "seq": msg['seq'],
+        "role": msg['role'],
+        "content": msg['content'],
+        "timestamp": msg['timestamp'],
+        "connection_noise": is_connection_noise(msg)
+    }
+
+class ChatWriteBehind:
+    """Background queue that persists chat messages after the response is sent
+    
+    Messages queued for the same user are coalesced into one list, and each
+    flush writes every pending user's messages in a single batched insert.
+    `write_batch` gets {user_id: messages} and may renumber messages in
+    place. Batches are retried with exponential backoff only while storage
+    is unavailable, so it must be idempotent. An error the database
+    answered with fails the batch at once, and each user's messages are then
+    tried on their own so one bad row can't hold up everyone else. Until a
+    write succeeds its messages stay visible through pending(), so reads in
+    this process never miss a turn.
+    """
+    
+    def __init__(self, write_batch, interval=0.05, max_retries=5, base_backoff=0.5, max_backoff=30.0):
+        self.write_batch = write_batch
+        self.interval = interval
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failed_batches = 0
+        self.dropped_messages = 0
+        self._pending = {}  # user_id -> messages waiting to be written
+        self._inflight = {}  # user_id -> messages currently being written
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def enqueue(self, user_id, messages):
+        """Queue messages for a user and wake the writer"""
+        with self._cond:
+            self._pending.setdefault(user_id, []).extend(messages)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+    
+    def pending(self, user_id):
+        """Return a user's messages that are queued or being written, in seq order"""
+        with self._cond:
+            return self._inflight.get(user_id, []) + self._pending.get(user_id, [])
+    
+    def depth(self):
+        """Number of messages not yet written"""
+        with self._cond:
+            return sum(len(msgs) for msgs in self._pending.values()) + \
+                sum(len(msgs) for msgs in self._inflight.values())
+    
+    def stats(self):
+        """Queue depth and failure counters for /api/health"""
+        return {
+            "depth": self.depth(),
+            "failed_batches": self.failed_batches,
+            "dropped_messages": self.dropped_messages
+        }
+    
+    def flush(self, timeout=10.0):
+        """Block until everything queued so far is written (or the timeout passes)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning("⚠️ Write-behind flush timed out with %d messages unsaved", self.depth())
+                    return False
+                self._cond.notify_all()
+                self._cond.wait(min(remaining, 0.1))
+        return True
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Give closely spaced turns a moment to join the same batch
+            time.sleep(self.interval)
+            with self._cond:
+                self._inflight, self._pending = self._pending, {}
+                batch = self._inflight
+            self._write(batch)
+            with self._cond:
+                self._inflight = {}
+                self._cond.notify_all()
+    
+    def _write(self, batch):
+        error = self._write_with_retry(batch)
+        if error is None:
+            return
+        # Retry users one at a time so a single bad row doesn't sink the batch;
+        # while storage is down they would only fail the same way
+        for user_id, msgs in batch.items():
+            if len(batch) > 1 and not isinstance(error, StorageUnavailable) and \
+                    self._write_with_retry({user_id: msgs}) is None:
+                continue
+            self.dropped_messages += len(msgs)
+            log.error("❌ Dropped %d unsaved messages", len(msgs), extra=log_fields(user_id=user_id))
+    
+    def _write_with_retry(self, batch):
+        """Write a batch, retrying while storage is unavailable; returns the final error, or None"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write_batch(batch)
+                return None
+            except StorageUnavailable as e:
+                self.failed_batches += 1
+                log.warning("Write-behind Error (attempt %d): %s", attempt + 1, e)
+                if attempt == self.max_retries:
+                    return e
+                backoff = min(self.base_backoff * (2 ** attempt), self.max_backoff)
+                # An open circuit won't let anything through before retry_after
+                time.sleep(max(backoff, e.retry_after))
+            except Exception as e:
+                # The database rejected the rows (e.g. a constraint); retrying won't help
+                self.failed_batches += 1
+                log.error("Write-behind Error: %s", e)
+                return e
+
+
+def merge_pending(stored, pending):
+    """Merge stored messages with unflushed ones, dropping duplicates, in seq order"""
+    if not pending:
+        return stored
+    seen = {msg['seq'] for msg in stored}
+    return sorted(stored + [msg for msg in pending if msg['seq'] not in seen], key=lambda m: m['seq'])
+
+
+class StorageUnavailable(Exception):
+    """Raised when storage calls are failing fast or timed out"""
+    
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fail-fast guard around calls to a remote service
+    
+    - closed: calls go through; `failure_threshold` failures in a row open it
+    - open: calls raise StorageUnavailable at once for `reset_timeout` seconds
+    - half_open: one probe call at a time is let through; success closes the
+      circuit and failure opens it again
+    
+    Every call has a deadline. With gevent it is enforced with gevent.Timeout;
+    otherwise the call runs on a small thread pool and the caller stops
+    waiting at the deadline. Errors the service answered with (they carry a
+    Postgres `code`, like PostgREST's APIError) show it is up, don't count and
+    are re-raised as is; any other failure is raised as StorageUnavailable.
+    """
+    
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, workers=8):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.workers = workers
+        self.state = 'closed'
+        self.failures = 0  # consecutive
+        self.opened_at = None
+        self.opens = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._probing = False
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def _admit(self):
+        """Check the state before a call; returns True if the call is the half-open probe"""
+        with self._lock:
+            if self.state == 'open':
+                wait = self.opened_at + self.reset_timeout - time.monotonic()
+                if wait > 0:
+                    self.rejected += 1
+                    raise StorageUnavailable(f"{self.name} circuit is open", wait)
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self._probing:
+                    self.rejected += 1
+                    raise StorageUnavailable(f"{self.name} circuit is half-open", 1.0)
+                self._probing = True
+                return True
+            return False
+    
+    def _record(self, ok, probe):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if ok:
+                if self.state != 'closed':
+                    log.info("✅ %s circuit closed", self.name)
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if probe or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opens += 1
+                    log.warning("🔌 %s circuit opened after %d failures", self.name, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+    
+    def _get_executor(self):
+        # Created on first use in each process, so forked workers get their own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='storage-call')
+                self._pid = os.getpid()
+            return self._executor
+    
+    def _run(self, fn, timeout):
+        if ASYNC_MODE:
+            import gevent
+            deadline = gevent.Timeout(timeout)
+            deadline.start()
+            try:
+                return fn()
+            except gevent.Timeout as e:
+                if e is not deadline:
+                    raise
+            finally:
+                deadline.cancel()
+        else:
+            # Copy the context so request-scoped state (e.g. the endpoint) is visible to the call
+            future = self._get_executor().submit(contextvars.copy_context().run, fn)
+            try:
+                return future.result(timeout=timeout)
+            except TimeoutError:
+                pass
+        self.timeouts += 1
+        raise StorageUnavailable(f"{self.name} call timed out after {timeout:g}s")
+    
+    def call(self, fn, timeout):
+        """Run fn() with a deadline, failing fast while the circuit is open"""
+        probe = self._admit()
+        try:
+            result = self._run(fn, timeout)
+        except StorageUnavailable:
+            self._record(False, probe)
+            raise
+        except Exception as e:
+            if getattr(e, 'code', None) is not None:
+                self._record(True, probe)
+                raise
+            self._record(False, probe)
+            raise StorageUnavailable(f"{self.name} call failed: {e}") from e
+        self._record(True, probe)
+        return result
+    
+    def stats(self):
+        """Circuit state and counters for /api/health"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opens": self.opens,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts
+            }
+
+
+class StorageBackend(abc.ABC):
+    """Interface for user and chat storage used by the API routes
+    
+    Users are dicts with 'id', 'username', 'password' (hash), 'gender' and
+    'bot_name'. Messages are dicts with 'seq', 'role', 'content',
+    'timestamp' and, where stored, 'connection_noise'; lists of messages
+    are always returned oldest first.
+    """
+    
+    name = "Unknown"
+    
+    @abc.abstractmethod
+    def find_user(self, username):
+        """Get a user by username, or None"""
+    
+    @abc.abstractmethod
+    def create_user(self, username, password_hash, gender, bot_name):
+        """Create a user and return its id; raises ValueError if the username is taken"""
+    
+    @abc.abstractmethod
+    def update_user(self, user_id, **fields):
+        """Update a user's fields and return the updated user, or None if not found"""
+    
+    @abc.abstractmethod
+    def get_all_messages(self, user_id):
+        """Get every message"""
+    
+    @abc.abstractmethod
+    def get_turn_context(self, user_id, limit=CHAT_TAIL_SIZE):
+        """Get what a chat turn needs before calling Gemini: (newest `limit` messages, summary)"""
+    
+    @abc.abstractmethod
+    def get_chat_version(self, user_id):
+        """Seq of the newest message (0 if none)
+        
+        Messages are only ever appended, so this changes exactly when the
+        history does and can validate cached history without loading it.
+        """
+    
+    @abc.abstractmethod
+    def get_messages_page(self, user_id, before=None, after=None, since=None, limit=50):
+        """Get one page of messages
+        
+        - before: messages with seq < before (newest page when no cursor is given)
+        - after: messages with seq > after
+        - since: messages with a timestamp later than this ISO timestamp
+        
+        Up to limit + 1 messages are returned so callers can tell whether more
+        remain; see get_chat_history.
+        """
+    
+    @abc.abstractmethod
+    def append_messages(self, user_id, messages):
+        """Append new messages (already numbered with `seq`)"""
+    
+    @abc.abstractmethod
+    def search_messages(self, user_id, terms, limit=20, offset=0):
+        """Search a user's messages for `terms` (see search_terms)
+        
+        Returns hits ({'seq', 'role', 'timestamp', 'snippet'}) best match
+        first, skipping `offset` and returning up to limit + 1 so callers can
+        tell whether more remain.
+        """
+    
+    @abc.abstractmethod
+    def get_summary(self, user_id):
+        """Get the chat's rolling summary ({'summary', 'through_seq'}, empty if none)"""
+    
+    @abc.abstractmethod
+    def save_summary(self, user_id, summary, through_seq):
+        """Save the rolling summary covering messages up to through_seq"""
+    
+    def flush(self):
+        """Write out anything still buffered"""
+    
+    def healthy(self):
+        """Whether calls are currently expected to succeed"""
+        return True
+    
+    def stats(self):
+        """Backend-specific counters for /api/health"""
+        return {}
+
+
+class LocalBackend(StorageBackend):
+    """Storage on top of the local user and chat stores (SQLite or memory)"""
+    
+    def __init__(self, users, chats, name):
+        self.users = users
+        self.chats = chats
+        self.name = name
+    
+    def find_user(self, username):
+        return self.users.find_by_username(username)
+    
+    def create_user(self, username, password_hash, gender, bot_name):
+        user_id = str(uuid.uuid4())
+        self.users.create(
+            user_id,
+            username,
+            password=password_hash,
+            gender=gender,
+            bot_name=bot_name,
+            created_at=datetime.now(timezone.utc).isoformat()
+        )
+        return user_id
+    
+    def update_user(self, user_id, **fields):
+        if user_id not in self.users:
+            return None
+        return self.users.update(user_id, **fields)
+    
+    def get_turn_context(self, user_id, limit=CHAT_TAIL_SIZE):
+        return self.chats.get_messages(user_id, limit), self.chats.get_summary(user_id)
+    
+    def get_all_messages(self, user_id):
+        return self.chats.get_messages(user_id)
+    
+    def get_chat_version(self, user_id):
+        return self.chats.last_seq(user_id)
+    
+    def get_messages_page(self, user_id, before=None, after=None, since=None, limit=50):
+        return self.chats.get_page(user_id, before, after, since, limit)
+    
+    def append_messages(self, user_id, messages):
+        self.chats.append(user_id, messages)
+    
+    def search_messages(self, user_id, terms, limit=20, offset=0):
+        return self.chats.search(user_id, terms, limit, offset)
+    
+    def get_summary(self, user_id):
+        return self.chats.get_summary(user_id)
+    
+    def save_summary(self, user_id, summary, through_seq):
+        self.chats.save_summary(user_id, summary, through_seq)
+
+
+class SupabaseBackend(StorageBackend):
+    """Storage in Supabase tables (users, chat_messages, chat_summaries)
+    
+    With write_behind, new messages are queued on a ChatWriteBehind and
+    reads merge in whatever hasn't been written yet. Unflushed messages are
+    only visible to this process, so multi-worker deployments should keep a
+    user on one worker or disable write-behind.
+    """
+    
+    name = "Supabase"
+    MESSAGE_COLUMNS = 'seq, role, content, timestamp, connection_noise'
+    
+    # Postgres / PostgREST error codes for a table that doesn't exist
+    UNDEFINED_TABLE_CODES = ('42P01', 'PGRST205')
+    # Times a write renumbers messages whose seqs concurrent turns keep taking
+    SEQ_CONFLICT_RETRIES = 3
+    
+    def __init__(self, client, write_behind=True, breaker=None, read_timeout=3.0, write_timeout=10.0):
+        self.client = client
+        self.write_behind = write_behind
+        # Cleared once the legacy chats table turns out not to exist (fresh installs)
+        self.legacy_chats = True
+        self.breaker = breaker or CircuitBreaker('Supabase')
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.writer = ChatWriteBehind(self._write_messages)
+    
+    def _execute(self, query, write=False):
+        """Run a query through the circuit breaker with the read or write timeout"""
+        return self.breaker.call(query.execute, self.write_timeout if write else self.read_timeout)
+    
+    def _write_messages(self, batch):
+        """Write {user_id: messages} in one upsert, settling seqs a concurrent turn took
+        
+        Rows already stored are skipped, so retrying a write that timed out
+        after it landed is a no-op instead of a duplicate key error. A skipped
+        message whose seq holds a different message lost a race with another
+        turn (e.g. on another worker): it is renumbered in place to follow the
+        newest stored message and written again.
+        """
+        for attempt in range(self.SEQ_CONFLICT_RETRIES + 1):
+            rows = [message_row(user_id, msg) for user_id, msgs in batch.items() for msg in msgs]
+            result = self._execute(self.client.table('chat_messages')
+                .upsert(rows, on_conflict='user_id,seq', ignore_duplicates=True), write=True)
+            written = {(str(row['user_id']), row['seq']) for row in result.data or []}
+            conflicts = {}
+            for user_id, msgs in batch.items():
+                skipped = [msg for msg in msgs if (user_id, msg['seq']) not in written]
+                taken = self._renumber_taken(user_id, skipped) if skipped else []
+                if taken:
+                    conflicts[user_id] = taken
+            if not conflicts:
+                return
+            log.info("🔢 Renumbered messages after a seq conflict", extra=log_fields(users=len(conflicts)))
+            batch = conflicts
+        raise RuntimeError(f"Message seqs still taken after {self.SEQ_CONFLICT_RETRIES} renumberings")
+    
+    def _renumber_taken(self, user_id, skipped):
+        """Renumber the skipped messages whose seq holds a different stored message, and return them"""
+        result = self._execute(self.client.table('chat_messages').select('seq, role, content, timestamp')
+            .eq('user_id', user_id).gt('seq', skipped[0]['seq'] - 1).order('seq'))
+        stored = {row['seq']: row for row in result.data or []}
+        taken = []
+        for msg in skipped:
+            row = stored.get(msg['seq'])
+            if row is None or row['role'] != msg['role'] or row['content'] != msg['content'] or \
+                    normalize_timestamp(row['timestamp']) != normalize_timestamp(msg['timestamp']):
+                taken.append(msg)
+        for seq, msg in enumerate(taken, start=max(stored, default=0) + 1):
+            msg['seq'] = seq
+        return taken
+    
+    def find_user(self, username):
+        result = self._execute(self.client.table('users').select('*').eq('username', username))
+        if not result.data:
+            return None
+        return {**result.data[0], 'id': str(result.data[0]['id'])}
+    
+    def create_user(self, username, password_hash, gender, bot_name):
+        user_data = {
+            "username": username,
+            "password": password_hash,
+            "gender": gender,
+            "bot_name": bot_name,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            result = self._execute(self.client.table('users').insert(user_data), write=True)
+        except Exception as e:
+            if getattr(e, 'code', None) == '23505':  # unique_violation
+                raise ValueError("Username already exists") from e
+            raise
+        if not result.data:
+            raise Exception("Supabase insert failed")
+        return str(result.data[0]['id'])
+    
+    def update_user(self, user_id, **fields):
+        result = self._execute(self.client.table('users').update(fields).eq('id', user_id), write=True)
+        return result.data[0] if result.data else None
+    
+    def _select_legacy_chats(self, query):
+        """Run a query on the legacy chats table; None if the table doesn't exist"""
+        if not self.legacy_chats:
+            return None
+        try:
+            return self._execute(query)
+        except Exception as e:
+            if getattr(e, 'code', None) not in self.UNDEFINED_TABLE_CODES:
+                raise
+            log.info("No legacy chats table - skipping chat migration from now on")
+            self.legacy_chats = False
+            return None
+    
+    def migrate_chat_blob(self, user_id):
+        """Copy a legacy chats.messages blob into chat_messages rows
+        
+        Returns the migrated messages (empty if the user has no legacy chat,
+        or there is no chats table at all). Upserting on (user_id, seq) makes
+        this safe to run more than once.
+        """
+        result = self._select_legacy_chats(self.client.table('chats').select('messages').eq('user_id', user_id))
+        if result is None or not result.data:
+            return []
+        
+        messages = []
+        for seq, msg in enumerate(result.data[0].get('messages') or [], start=1):
+            messages.append({
+                "role": msg.get('role', 'user'),
+                "content": msg.get('content', ''),
+                "timestamp": msg.get('timestamp') or datetime.now(timezone.utc).isoformat(),
+                "seq": seq
+            })
+            messages[-1]['connection_noise'] = is_connection_noise(messages[-1])
+        
+        for start in range(0, len(messages), SUPABASE_PAGE_SIZE):
+            rows = [message_row(user_id, msg) for msg in messages[start:start + SUPABASE_PAGE_SIZE]]
+            self._execute(self.client.table('chat_messages').upsert(rows, on_conflict='user_id,seq', ignore_duplicates=True), write=True)
+        
+        if messages:
+            log.info("📦 Migrated %d messages to chat_messages", len(messages), extra=log_fields(user_id=user_id))
+        return messages
+    
+    def migrate_all_chat_blobs(self):
+        """Migrate every legacy chats row into chat_messages"""
+        migrated = 0
+        start = 0
+        while True:
+            result = self._select_legacy_chats(self.client.table('chats').select('user_id').range(start, start + SUPABASE_PAGE_SIZE - 1))
+            rows = (result.data or []) if result is not None else []
+            for row in rows:
+                existing = self._execute(self.client.table('chat_messages').select('seq').eq('user_id', row['user_id']).limit(1))
+                if not existing.data:
+                    self.migrate_chat_blob(row['user_id'])
+                    migrated += 1
+            if len(rows) < SUPABASE_PAGE_SIZE:
+                break
+            start += SUPABASE_PAGE_SIZE
+        
+        log.info("✅ Migrated %d chats to chat_messages", migrated)
+        return migrated
+    
+    def get_turn_context(self, user_id, limit=CHAT_TAIL_SIZE):
+        # One request: the user's row with the newest messages and the summary
+        # embedded through their foreign keys to users. Unflushed messages are
+        # snapshotted before reading so none can slip between the two.
+        pending = self.writer.pending(user_id)
+        result = self._execute(self.client.table('users')
+            .select(f'id, chat_messages({self.MESSAGE_COLUMNS}), chat_summaries(summary, through_seq)')
+            .eq('id', user_id)
+            .order('seq', desc=True, foreign_table='chat_messages')
+            .limit(limit, foreign_table='chat_messages'))
+        row = result.data[0] if result.data else {}
+        summary = row.get('chat_summaries') or {}
+        if isinstance(summary, list):
+            # PostgREST before v10 embeds one-to-one relationships as a list
+            summary = summary[0] if summary else {}
+        stored = list(reversed(row.get('chat_messages') or []))
+        if stored or pending:
+            return merge_pending(stored, pending)[-limit:], summary
+        # No message rows yet - pull in a legacy blob if there is one
+        return self.migrate_chat_blob(user_id)[-limit:], summary
+    
+    def get_all_messages(self, user_id):
+        pending = self.writer.pending(user_id)
+        messages = []
+        start = 0
+        while True:
+            result = self._execute(self.client.table('chat_messages').select('seq, role, content, timestamp')
+                .eq('user_id', user_id).order('seq')
+                .range(start, start + SUPABASE_PAGE_SIZE - 1))
+            rows = result.data or []
+            messages.extend(rows)
+            if len(rows) < SUPABASE_PAGE_SIZE:
+                break
+            start += SUPABASE_PAGE_SIZE
+        if not messages and not pending:
+            return self.migrate_chat_blob(user_id)
+        return merge_pending(messages, pending)
+    
+    def get_chat_version(self, user_id):
+        pending = self.writer.pending(user_id)
+        result = self._execute(self.client.table('chat_messages').select('seq')
+            .eq('user_id', user_id).order('seq', desc=True).limit(1))
+        stored = result.data[0]['seq'] if result.data else 0
+        return max([stored] + [msg['seq'] for msg in pending])
+    
+    def get_messages_page(self, user_id, before=None, after=None, since=None, limit=50):
+        pending = self.writer.pending(user_id)
+        query = self.client.table('chat_messages').select('seq, role, content, timestamp').eq('user_id', user_id)
+        if since is not None:
+            result = self._execute(query.gt('timestamp', since).order('seq').limit(limit + 1))
+            pending = [msg for msg in pending if msg['timestamp'] > since]
+            return merge_pending(result.data or [], pending)[:limit + 1]
+        if after is not None:
+            result = self._execute(query.gt('seq', after).order('seq').limit(limit + 1))
+            pending = [msg for msg in pending if msg['seq'] > after]
+            return merge_pending(result.data or [], pending)[:limit + 1]
+        if before is not None:
+            query = query.lt('seq', before)
+            pending = [msg for msg in pending if msg['seq'] < before]
+        result = self._execute(query.order('seq', desc=True).limit(limit + 1))
+        if result.data or pending:
+            return merge_pending(list(reversed(result.data or [])), pending)[-(limit + 1):]
+        if before is None:
+            # No message rows yet - pull in a legacy blob if there is one
+            return self.migrate_chat_blob(user_id)[-(limit + 1):]
+        return []
+    
+    def append_messages(self, user_id, messages):
+        if self.write_behind:
+            self.writer.enqueue(user_id, messages)
+        else:
+            self._write_messages({user_id: messages})
+    
+    def search_messages(self, user_id, terms, limit=20, offset=0):
+        # Ranked and highlighted in Postgres by search_chat_messages (see
+        # README); write-behind messages become searchable once written
+        query = ' & '.join(terms[:-1] + [terms[-1] + ':*'])
+        result = self._execute(self.client.rpc('search_chat_messages', {
+            "p_user_id": user_id,
+            "p_query": query,
+            "p_limit": limit + 1,
+            "p_offset": offset
+        }))
+        return result.data or []
+    
+    def get_summary(self, user_id):
+        result = self._execute(self.client.table('chat_summaries').select('summary, through_seq').eq('user_id', user_id))
+        return result.data[0] if result.data else {}
+    
+    def save_summary(self, user_id, summary, through_seq):
+        self._execute(self.client.table('chat_summaries').upsert({
+            "user_id": user_id,
+            "summary": summary,
+            "through_seq": through_seq,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }), write=True)
+    
+    def flush(self):
+        self.writer.flush()
+    
+    def healthy(self):
+        return self.breaker.state == 'closed'
+    
+    def stats(self):
+        stats = {"write_queue": self.writer.stats(), "circuit": self.breaker.stats()}
+        if hasattr(self.client, 'stats'):
+            stats["client"] = self.client.stats()
+        return stats
 
-load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# Chat writes to Supabase are queued by default; CHAT_WRITE_BEHIND=0 makes
+# them synchronous again
+USE_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', '1').lower() not in ('0', 'false', 'no')
 
-# Request logging for debugging
-@app.before_request
-def log_request_info():
-    """Log incoming requests for debugging"""
-    if request.path.startswith('/api/'):
-        print(f"\n📥 {request.method} {request.path}")
-        if request.is_json:
-            data = request.get_json()
-            # Don't log passwords
-            if data and 'password' in data:
-                log_data = {**data, 'password': '***'}
-                print(f"   Body: {log_data}")
-            else:
-                print(f"   Body: {data}")
+# After SUPABASE_BREAKER_FAILURES failed calls in a row, Supabase calls fail
+# fast for SUPABASE_BREAKER_RESET seconds before a single probe is let through
+SUPABASE_BREAKER = CircuitBreaker(
+    'Supabase',
+    failure_threshold=int(os.getenv('SUPABASE_BREAKER_FAILURES', '5')),
+    reset_timeout=float(os.getenv('SUPABASE_BREAKER_RESET', '30'))
+)
 
-# Supabase Configuration
-SUPABASE_URL = os.getenv('SUPABASE_URL', '')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY', '')
+# Set by init_storage()
+LOCAL_BACKEND = None
+STORAGE = None
 
-# Initialize Supabase client
-USE_SUPABASE = False
-supabase = None
-if SUPABASE_URL and SUPABASE_KEY:
-    try:
-        from supabase import create_client, Client
-        supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-        USE_SUPABASE = True
-        print("✅ Supabase Client Initialized!")
-        print("   (Connection will be tested on first database operation)")
-    except Exception as e:
-        print(f"⚠️ Supabase Connection Failed: {e}")
-        print(traceback.format_exc())
-        print("📦 Using in-memory storage")
-        USE_SUPABASE = False
-        supabase = None
-else:
-    print("⚠️ Supabase credentials not found")
-    print("📦 Using in-memory storage")
-
-# Fallback to in-memory storage (always initialize)
-MEMORY_USERS = {}
-MEMORY_CHATS = {}
 
-# Gemini Configuration
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ Gemini API Connected!")
-    except Exception as e:
-        print(f"⚠️ Gemini API Configuration Error: {e}")
-        GEMINI_API_KEY = ''  # Reset if configuration fails
-else:
-    print("⚠️ Gemini API key not found - app will start but AI features may not work")
+def init_storage():
+    """Open local storage and pick the backend the API routes use"""
+    global LOCAL_BACKEND, STORAGE
+    if LOCAL_STORAGE == 'memory':
+        users, chats = MemoryUserStore(), MemoryChatStore()
+    else:
+        db = SQLiteDatabase(SQLITE_PATH)
+        users, chats = SQLiteUserStore(db), SQLiteChatStore(db)
+    LOCAL_BACKEND = LocalBackend(users, chats, LOCAL_STORAGE_NAMES[LOCAL_STORAGE])
+    if USE_SUPABASE:
+        STORAGE = SupabaseBackend(supabase, USE_WRITE_BEHIND, SUPABASE_BREAKER, SUPABASE_READ_TIMEOUT, SUPABASE_WRITE_TIMEOUT)
+    else:
+        STORAGE = LOCAL_BACKEND
+    atexit.register(STORAGE.flush)
 
-# Base system prompt template
-def get_system_prompt(user_gender, bot_name):
-    """Generate gender-aware system prompt based on user's gender (opposite)"""
-    # Determine bot's gender (opposite of user)
-    # If user is male, bot is female; if user is female, bot is male; if user is other, bot is female
-    if user_gender == "male":
-        bot_gender = "female"
-    elif user_gender == "female":
-        bot_gender = "male"
-    else:  # other
-        bot_gender = "female"  # Default to female for variety
+
+# Password hashing and login throttling
+# Password hashes are deliberately slow, so they run in a small process pool
+# (with gevent, in the hub's native thread pool, since multiprocessing pipes
+# would block the event loop) and at most PASSWORD_HASH_QUEUE may be pending;
+# beyond that requests are turned away instead of tying up request threads.
+# PASSWORD_HASH_METHOD sets the algorithm and work factor in werkzeug's format,
+# e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"; existing hashes keep
+# verifying with the parameters they were created with.
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already pending"""
+
+
+class PasswordHasher:
+    """Bounded off-thread password hashing and verification"""
     
-    gender_pronouns = "she/her" if bot_gender == "female" else "he/him"
-    gender_identity = "woman" if bot_gender == "female" else "man"
+    def __init__(self, method='scrypt', workers=2, max_pending=16, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
     
-    return f"""You are {bot_name}, a caring, empathetic virtual partner. You are a {gender_identity} ({gender_pronouns}).
-
-CRITICAL RESPONSE GUIDELINES:
-- Match the user's message length and energy level. Short messages get short responses. Long messages can get longer responses.
-- Be natural and conversational, like texting with a close friend
-- Keep responses brief and human-like (1-3 sentences for short messages, max 2-3 sentences for longer topics)
-- Use casual, everyday language - avoid formal or overly structured responses
-- Use emojis sparingly (1-2 max per message, only when natural)
-- Don't over-explain or repeat yourself
-- Respond with genuine care, but keep it concise and real
+    def _get_executor(self):
+        # Created on first use in each process, so forked workers get their own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+    
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy("Too many password checks in progress")
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            if ASYNC_MODE:
+                from gevent import get_hub
+                return get_hub().threadpool.apply(fn, args)
+            return self._get_executor().submit(fn, *args).result(timeout=self.timeout)
+        finally:
+            self._slots.release()
+    
+    def hash(self, password):
+        """Hash a password with the configured method and work factor"""
+        return self._run(generate_password_hash, password, self.method)
+    
+    def verify(self, password_hash, password):
+        """Check a password against a stored hash"""
+        return self._run(check_password_hash, password_hash, password)
 
-CONVERSATION STYLE:
-- If user says "hi" or "hey" → respond with a brief friendly greeting (1 sentence)
-- If user asks a question → answer directly and briefly
-- If user shares something personal → acknowledge briefly, show you care, maybe ask one short follow-up
-- Match the tone: casual for casual, serious for serious
-- Be supportive but don't be preachy or give long advice unless asked
 
-REMEMBER:
-- You are {bot_name} - use your name naturally if it comes up, but don't force it
-- Ignore old messages about connection issues
-- Focus on the current conversation
-- Keep it REAL and HUMAN - avoid sounding like a chatbot"""
+PASSWORD_HASHER = PasswordHasher(
+    method=os.getenv('PASSWORD_HASH_METHOD', 'scrypt'),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', '2')),
+    max_pending=int(os.getenv('PASSWORD_HASH_QUEUE', '16'))
+)
 
 
-def filter_connection_messages(messages):
-    """Filter out old connection-related messages that are no longer relevant"""
-    connection_phrases = [
-        "connection failed", "connection issues", "connection problem",
-        "connection error", "are now connected", "connection is better",
-        "connection working", "connection stable", "checking if the connection",
-        "connection working better", "no, are now connected"
-    ]
-    
-    filtered = []
-    for msg in messages:
-        content_lower = msg.get('content', '').lower()
-        # Only filter assistant messages that are clearly about connection issues
-        if msg.get('role') == 'assistant':
-            # Check if message is primarily about connection issues
-            is_connection_message = any(phrase in content_lower for phrase in connection_phrases)
-            # Also check for patterns like "connection" + "better" or "connected" + "checking"
-            if not is_connection_message:
-                if ('connection' in content_lower and 'better' in content_lower) or \
-                   ('connected' in content_lower and 'checking' in content_lower) or \
-                   ('connection' in content_lower and 'still' in content_lower and 'checking' in content_lower):
-                    is_connection_message = True
-            
-            # Skip connection-related assistant messages
-            if is_connection_message:
-                continue
-        
-        filtered.append(msg)
+class AttemptThrottle:
+    """Sliding-window limit on attempts per key (client IP or username)"""
     
-    return filtered
-
-def get_ai_response(user_message, conversation_history, user_gender="other", bot_name="Virtual Partner"):
-    """Get response from Gemini API with gender-aware context"""
-    if not GEMINI_API_KEY:
-        return f"I'm sorry, but I'm not properly configured right now. Please check the server configuration. 😔"
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts = OrderedDict()  # key -> deque of attempt times, least recently used first
+        self._lock = threading.Lock()
     
-    try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Filter out old connection-related messages
-        filtered_history = filter_connection_messages(conversation_history)
-        
-        # Get gender-aware system prompt
-        system_prompt = get_system_prompt(user_gender, bot_name)
-        
-        # Determine response length based on user message
-        user_msg_length = len(user_message.split())
-        if user_msg_length <= 5:  # Very short (hi, hey, thanks, etc.)
-            max_tokens = 50  # Keep responses very short
-            response_instruction = "Keep your response VERY brief - 1 short sentence max."
-        elif user_msg_length <= 15:  # Short message
-            max_tokens = 100  # Short response
-            response_instruction = "Keep your response brief - 1-2 sentences."
-        elif user_msg_length <= 50:  # Medium message
-            max_tokens = 200  # Medium response
-            response_instruction = "Keep your response concise - 2-3 sentences."
-        else:  # Long message
-            max_tokens = 300  # Can be longer but still concise
-            response_instruction = "Respond naturally but keep it concise - 2-4 sentences max."
-        
-        # Build conversation context
-        context = system_prompt + "\n\n" + response_instruction + "\n\nConversation:\n"
-        
-        # Add last 10 messages for context (reduced to avoid over-context)
-        for msg in filtered_history[-10:]:
-            role = "User" if msg["role"] == "user" else bot_name
-            context += f"{role}: {msg['content']}\n"
-        
-        context += f"User: {user_message}\n{bot_name}:"
-        
-        print(f"\n🤖 Generating AI response for: {user_message[:50]}...")
-        print(f"👤 User Gender: {user_gender}, 🤖 Bot Name: {bot_name}, 📏 Max tokens: {max_tokens}")
-        
-        response = model.generate_content(
-            context,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7,  # Slightly lower for more consistent, natural responses
-                max_output_tokens=max_tokens,
-                top_p=0.9,
-                top_k=40
-            )
-        )
-        
-        response_text = response.text.strip()
-        
-        # Post-process: if response is still too long for short messages, truncate it
-        if user_msg_length <= 5 and len(response_text.split()) > 15:
-            # For very short user messages, force shorter response
-            sentences = response_text.split('. ')
-            response_text = '. '.join(sentences[:1])
-            if not response_text.endswith('.') and not response_text.endswith('!') and not response_text.endswith('?'):
-                response_text += '.'
-        
-        print(f"✅ AI Response: {response_text[:100]}...")
-        return response_text
+    def _recent(self, key, now):
+        attempts = self._attempts.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self._attempts[key]
+            return None
+        return attempts
     
-    except Exception as e:
-        error_msg = f"AI Error: {e}\n{traceback.format_exc()}"
-        print(error_msg)
-        
-        # Check for rate limiting
-        if "429" in str(e) or "Resource exhausted" in str(e):
-            return f"Too many requests right now 😅 Try again in a moment!"
-        
-        return f"Something went wrong. Can you try again?"
+    def retry_after(self, key):
+        """Seconds until `key` may try again (0 if it may try now)"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None or len(attempts) < self.limit:
+                return 0
+            return attempts[0] + self.window - now
+    
+    def record(self, key):
+        """Count an attempt"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None:
+                attempts = self._attempts[key] = deque()
+            attempts.append(now)
+            self._attempts.move_to_end(key)
+            while len(self._attempts) > self.max_keys:
+                self._attempts.popitem(last=False)
+    
+    def reset(self, key):
+        """Forget a key's attempts"""
+        with self._lock:
+            self._attempts.pop(key, None)
 
 
-# Memory Storage Functions (Fallback)
-def memory_find_user(username):
-    """Find user in memory storage"""
-    for user_id, user in MEMORY_USERS.items():
-        if user['username'] == username:
-            return {**user, 'id': user_id}
-    return None
+# Every login and registration counts against the client IP; only failed
+# logins count against the username. Counts are kept per process. Behind a
+# proxy every client shares the proxy's address, so the IP limit only applies
+# once PROXY_FIX says how to find the real one (or AUTH_IP_LIMIT is set
+# explicitly for a server that clients reach directly).
+AUTH_IP_THROTTLE_ENABLED = bool(PROXY_FIX) or 'AUTH_IP_LIMIT' in os.environ
+AUTH_IP_THROTTLE = AttemptThrottle(
+    limit=int(os.getenv('AUTH_IP_LIMIT', '30')),
+    window=float(os.getenv('AUTH_IP_WINDOW', '60'))
+)
+LOGIN_FAILURE_THROTTLE = AttemptThrottle(
+    limit=int(os.getenv('LOGIN_FAILURE_LIMIT', '5')),
+    window=float(os.getenv('LOGIN_FAILURE_WINDOW', '900'))
+)
+AUTH_THROTTLED = Counter('vp_auth_throttled_total', 'Login and registration attempts turned away', ('reason',))
 
-def memory_create_user(username, password, gender="other", bot_name="Virtual Partner"):
-    """Create user in memory storage"""
-    import uuid
-    user_id = str(uuid.uuid4())
-    MEMORY_USERS[user_id] = {
-        'username': username,
-        'password': password,
-        'gender': gender,
-        'bot_name': bot_name,
-        'created_at': datetime.now(timezone.utc).isoformat()
-    }
-    return user_id
 
-def memory_get_chat(user_id):
-    """Get chat from memory storage"""
-    return MEMORY_CHATS.get(user_id, {'messages': []})
+def throttled_response(retry_after, reason):
+    """429 with Retry-After for a throttled auth attempt"""
+    AUTH_THROTTLED.inc(reason)
+    log.warning("🚫 Auth attempt throttled (%s)", reason, extra=log_fields(ip=request.remote_addr))
+    response = jsonify({"error": "Too many attempts. Please wait a moment and try again."})
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response, 429
 
-def memory_save_chat(user_id, messages):
-    """Save chat to memory storage"""
-    MEMORY_CHATS[user_id] = {
-        'messages': messages,
-        'updated_at': datetime.now(timezone.utc).isoformat()
-    }
+
+def hasher_busy_response():
+    """503 when the password hashing queue is full"""
+    AUTH_THROTTLED.inc('hasher_busy')
+    response = jsonify({"error": "Server is busy. Please try again in a moment."})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+def storage_unavailable_response(error):
+    """503 with Retry-After while storage is failing fast or timing out"""
+    log.warning("🔌 Storage unavailable: %s", error)
+    response = jsonify({"error": "Service temporarily unavailable. Please try again shortly."})
+    response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.999)))
+    return response, 503
 
 
 @app.route('/api/auth/register', methods=['POST'])
@@ -254,16 +2298,14 @@ def register():
     try:
         # Handle request parsing
         if not request.is_json:
-            print("Registration Error: Request is not JSON")
+            log.info("Registration Error: Request is not JSON")
             return jsonify({"error": "Content-Type must be application/json"}), 400
         
         data = request.get_json()
         if not data:
-            print("Registration Error: No data in request")
+            log.info("Registration Error: No data in request")
             return jsonify({"error": "Invalid JSON in request body"}), 400
         
-        print(f"Registration attempt - Data received: {list(data.keys())}")
-        
         username = data.get('username')
         password = data.get('password')
         gender = data.get('gender', 'other')
@@ -277,14 +2319,16 @@ def register():
         if bot_name:
             bot_name = bot_name.strip()
         
-        print(f"Registration attempt - Username: '{username}', Password length: {len(password) if password else 0}, Gender: {gender}, Bot name: '{bot_name}'")
+        log.debug("Registration attempt", extra=log_fields(
+            username=username, password_length=len(password) if password else 0, gender=gender, bot_name=bot_name
+        ))
         
         if not username or len(username) == 0:
-            print("Registration Error: Username is empty")
+            log.info("Registration Error: Username is empty")
             return jsonify({"error": "Username is required"}), 400
         
         if not password or len(password) == 0:
-            print("Registration Error: Password is empty")
+            log.info("Registration Error: Password is empty")
             return jsonify({"error": "Password is required"}), 400
         
         if len(username) < 3:
@@ -299,62 +2343,34 @@ def register():
         if not bot_name or len(bot_name) == 0:
             bot_name = 'Virtual Partner'
         
-        # Try Supabase first if available, fall back to memory on error
-        user_id = None
-        if USE_SUPABASE and supabase is not None:
-            try:
-                print(f"Attempting to register user with Supabase: {username}")
-                # Check if user exists
-                result = supabase.table('users').select('*').eq('username', username).execute()
-                if result.data and len(result.data) > 0:
-                    print(f"Username '{username}' already exists in Supabase")
-                    return jsonify({"error": "Username already exists"}), 400
-                
-                # Create new user
-                user_data = {
-                    "username": username,
-                    "password": generate_password_hash(password),
-                    "gender": gender,
-                    "bot_name": bot_name.strip(),
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                }
-                result = supabase.table('users').insert(user_data).execute()
-                if not result.data or len(result.data) == 0:
-                    print("Warning: Supabase insert returned no data, falling back to memory storage")
-                    raise Exception("Supabase insert failed")
-                user_id = str(result.data[0]['id'])
-                print(f"User created successfully in Supabase with ID: {user_id}")
-            except Exception as db_error:
-                print(f"Database error during registration: {db_error}")
-                print(traceback.format_exc())
-                print("Falling back to in-memory storage")
-                user_id = None  # Reset to trigger memory storage
-        
-        # Use memory storage (either as primary or fallback)
-        if user_id is None:
-            if not USE_SUPABASE or supabase is None:
-                print(f"Using in-memory storage for registration: {username}")
-            else:
-                print(f"Falling back to in-memory storage for: {username}")
-            
-            existing_user = memory_find_user(username)
-            if existing_user:
-                print(f"Username '{username}' already exists in memory")
-                return jsonify({"error": "Username already exists"}), 400
-            
-            print(f"Creating new user in memory: {username}")
-            try:
-                user_id = memory_create_user(
-                    username, 
-                    generate_password_hash(password),
-                    gender,
-                    bot_name
-                )
-                print(f"User created successfully in memory with ID: {user_id}")
-            except Exception as mem_error:
-                print(f"Memory storage error: {mem_error}")
-                print(traceback.format_exc())
-                return jsonify({"error": "Failed to create user. Please try again."}), 500
+        client_ip = request.remote_addr or 'unknown'
+        if AUTH_IP_THROTTLE_ENABLED:
+            wait = AUTH_IP_THROTTLE.retry_after(client_ip)
+            if wait:
+                return throttled_response(wait, 'ip')
+            AUTH_IP_THROTTLE.record(client_ip)
+        
+        # Users only ever go to the configured storage; falling back to local
+        # storage during an outage would leave accounts login can't find.
+        # Taken usernames are turned away before paying for a password hash.
+        with timed_stage('user_lookup'):
+            existing_user = STORAGE.find_user(username)
+        if existing_user:
+            log.info("Username already exists in %s", STORAGE.name, extra=log_fields(username=username))
+            return jsonify({"error": "Username already exists"}), 400
+        
+        try:
+            with timed_stage('password'):
+                password_hash = PASSWORD_HASHER.hash(password)
+        except PasswordHasherBusy:
+            return hasher_busy_response()
+        
+        try:
+            user_id = STORAGE.create_user(username, password_hash, gender, bot_name)
+        except ValueError:
+            log.info("Username already exists in %s", STORAGE.name, extra=log_fields(username=username))
+            return jsonify({"error": "Username already exists"}), 400
+        log.info("User created in %s", STORAGE.name, extra=log_fields(username=username, user_id=user_id))
         
         return jsonify({
             "message": "User registered successfully",
@@ -363,16 +2379,17 @@ def register():
                 "username": username,
                 "gender": gender,
                 "bot_name": bot_name.strip()
-            }
+            },
+            "token": issue_session_token(user_id, gender, bot_name.strip())
         }), 201
     
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
+    
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"Registration Error: {e}")
-        print(f"Traceback: {error_details}")
+        log.error("Registration Error: %s", e, exc_info=True)
         # Always return detailed error message to help with debugging
         error_msg = f"Registration failed: {str(e)}"
-        print(f"Returning error to client: {error_msg}")
         return jsonify({"error": error_msg}), 500
 
 
@@ -393,22 +2410,40 @@ def login():
         
         if not username or not password:
             return jsonify({"error": "Username and password required"}), 400
+        if not isinstance(username, str) or not isinstance(password, str):
+            # No account has a non-string username or password
+            return jsonify({"error": "Invalid credentials"}), 401
         
-        if USE_SUPABASE:
-            result = supabase.table('users').select('*').eq('username', username).execute()
-            if not result.data or not check_password_hash(result.data[0]['password'], password):
-                return jsonify({"error": "Invalid credentials"}), 401
-            user_data = result.data[0]
-            user_id = str(user_data['id'])
-            gender = user_data.get('gender', 'other')
-            bot_name = user_data.get('bot_name', 'Virtual Partner')
-        else:
-            user = memory_find_user(username)
-            if not user or not check_password_hash(user['password'], password):
-                return jsonify({"error": "Invalid credentials"}), 401
-            user_id = user['id']
-            gender = user.get('gender', 'other')
-            bot_name = user.get('bot_name', 'Virtual Partner')
+        # Throttled attempts are turned away before any lookup or hashing
+        client_ip = request.remote_addr or 'unknown'
+        username_key = username.strip().lower()
+        if AUTH_IP_THROTTLE_ENABLED:
+            wait = AUTH_IP_THROTTLE.retry_after(client_ip)
+            if wait:
+                return throttled_response(wait, 'ip')
+        wait = LOGIN_FAILURE_THROTTLE.retry_after(username_key)
+        if wait:
+            return throttled_response(wait, 'username')
+        if AUTH_IP_THROTTLE_ENABLED:
+            AUTH_IP_THROTTLE.record(client_ip)
+        
+        with timed_stage('user_lookup'):
+            user = STORAGE.find_user(username)
+        if not user:
+            LOGIN_FAILURE_THROTTLE.record(username_key)
+            return jsonify({"error": "Invalid credentials"}), 401
+        try:
+            with timed_stage('password'):
+                password_ok = PASSWORD_HASHER.verify(user['password'], password)
+        except PasswordHasherBusy:
+            return hasher_busy_response()
+        if not password_ok:
+            LOGIN_FAILURE_THROTTLE.record(username_key)
+            return jsonify({"error": "Invalid credentials"}), 401
+        LOGIN_FAILURE_THROTTLE.reset(username_key)
+        user_id = user['id']
+        gender = user.get('gender', 'other')
+        bot_name = user.get('bot_name', 'Virtual Partner')
         
         return jsonify({
             "message": "Login successful",
@@ -417,107 +2452,304 @@ def login():
                 "username": username,
                 "gender": gender,
                 "bot_name": bot_name
-            }
+            },
+            "token": issue_session_token(user_id, gender, bot_name)
         }), 200
     
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
+    
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"Login Error: {e}")
-        print(f"Traceback: {error_details}")
+        log.error("Login Error: %s", e, exc_info=True)
         # Return more detailed error in development, generic in production
         error_msg = str(e) if os.getenv('FLASK_ENV') == 'development' else "Login failed"
         return jsonify({"error": error_msg}), 500
 
 
+# Per-user ordering and idempotency for chat turns
+class KeyedLocks:
+    """One lock per key, created on demand and discarded once nobody holds or waits on it"""
+    
+    def __init__(self):
+        self._locks = {}  # key -> [lock, users]
+        self._guard = threading.Lock()
+    
+    def acquire(self, key, timeout=-1):
+        """Acquire the lock for key; returns False if the timeout passes first"""
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        if entry[0].acquire(timeout=timeout):
+            return True
+        self._forget(key)
+        return False
+    
+    def release(self, key):
+        """Release the lock for key"""
+        self._locks[key][0].release()
+        self._forget(key)
+    
+    def _forget(self, key):
+        with self._guard:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class IdempotencyStore:
+    """Single-flight results for requests retried with the same idempotency key
+    
+    The first request for a key owns it; duplicates wait for the owner to
+    finish and receive its result. Finished results are kept for `ttl`
+    seconds, at most `max_size` of them.
+    """
+    
+    def __init__(self, max_size=10000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> {'event', 'result', 'expires_at'}
+        self._lock = threading.Lock()
+    
+    def begin(self, key):
+        """Claim key; returns (is_owner, entry)"""
+        with self._lock:
+            now = time.monotonic()
+            # Entries are kept in completion order, so expired ones are at the front
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest['expires_at'] is None or oldest['expires_at'] > now:
+                    break
+                self._entries.popitem(last=False)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return False, entry
+            entry = {'event': threading.Event(), 'result': None, 'expires_at': None}
+            self._entries[key] = entry
+            return True, entry
+    
+    def complete(self, key, result):
+        """Record the owner's result (None on failure, which frees the key for a retry)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['result'] = result
+            if result is None:
+                del self._entries[key]
+            else:
+                entry['expires_at'] = time.monotonic() + self.ttl
+                self._entries.move_to_end(key)
+                # Trim the oldest finished results; in-flight entries are never evicted
+                excess = len(self._entries) - self.max_size
+                if excess > 0:
+                    finished = [k for k, e in self._entries.items() if e['expires_at'] is not None][:excess]
+                    for k in finished:
+                        del self._entries[k]
+        entry['event'].set()
+    
+    @staticmethod
+    def wait(entry, timeout):
+        """Wait for the owner of entry to finish; returns its result or None"""
+        entry['event'].wait(timeout)
+        return entry['result']
+
+
+USER_CHAT_LOCKS = KeyedLocks()
+CHAT_IDEMPOTENCY = IdempotencyStore()
+# How long a message waits for an earlier turn from the same user (or for the
+# original request with the same idempotency key) before giving up
+CHAT_TURN_WAIT_SECONDS = 120
+
+
+def finish_chat_turn(user_id, idempotency_slot, outcome):
+    """Release the user's chat lock and publish the turn's result to duplicates"""
+    USER_CHAT_LOCKS.release(user_id)
+    if idempotency_slot is not None:
+        CHAT_IDEMPOTENCY.complete(idempotency_slot, outcome.get('result'))
+
+
+def replay_chat_result(result, stream):
+    """Answer a duplicate request with the original request's result"""
+    if result is None:
+        return jsonify({"error": "The original request for this idempotency key did not complete"}), 409
+    if stream:
+        events = sse_event('chunk', {"text": result['response']}) + sse_event('done', result)
+        return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    return jsonify(result), 200
+
+
 @app.route('/api/chat/message', methods=['POST'])
 def send_message():
-    """Send a message and get AI response"""
+    """Send a message and get AI response
+    
+    Requires a session token; the user and persona come from the token
+    ("userId" in the body is optional and must match it).
+    
+    Pass "stream": true in the body (or ?stream=1) to receive the reply as
+    Server-Sent Events: one "chunk" event per piece of text, then a "done"
+    event once the conversation has been saved.
+    """
     data = request.json
-    user_id = data.get('userId')
+    session = read_session_token()
+    error = session_error(session, data.get('userId'))
+    if error:
+        return error
+    user_id = session['uid']
     message = data.get('message')
+    stream = bool(data.get('stream')) or request.args.get('stream') in ('1', 'true')
+    
+    if not message:
+        return jsonify({"error": "Message required"}), 400
     
-    if not user_id or not message:
-        return jsonify({"error": "User ID and message required"}), 400
+    # A retried request with the same key gets the original result instead of a new generation
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+    idempotency_slot = None
+    if idempotency_key:
+        idempotency_slot = (user_id, str(idempotency_key))
+        is_owner, entry = CHAT_IDEMPOTENCY.begin(idempotency_slot)
+        if not is_owner:
+            log.info("🔁 Replaying result for idempotency key %s", idempotency_key)
+            return replay_chat_result(CHAT_IDEMPOTENCY.wait(entry, CHAT_TURN_WAIT_SECONDS), stream)
     
+    # Turns for the same user run one at a time so each sees the previous one
+    with timed_stage('lock_wait'):
+        acquired = USER_CHAT_LOCKS.acquire(user_id, timeout=CHAT_TURN_WAIT_SECONDS)
+    if not acquired:
+        if idempotency_slot is not None:
+            CHAT_IDEMPOTENCY.complete(idempotency_slot, None)
+        return jsonify({"error": "Another message is still being processed"}), 409
+    
+    outcome = {}
+    handed_off = False
     try:
-        # Get user info for gender and bot_name
-        if USE_SUPABASE:
-            user_result = supabase.table('users').select('*').eq('id', user_id).execute()
-            if user_result.data:
-                user_gender = user_result.data[0].get('gender', 'other')
-                bot_name = user_result.data[0].get('bot_name', 'Virtual Partner')
-            else:
-                user_gender = 'other'
-                bot_name = 'Virtual Partner'
-        else:
-            user = MEMORY_USERS.get(user_id)
-            if user:
-                user_gender = user.get('gender', 'other')
-                bot_name = user.get('bot_name', 'Virtual Partner')
-            else:
-                user_gender = 'other'
-                bot_name = 'Virtual Partner'
-        
-        # Get conversation history
-        if USE_SUPABASE:
-            result = supabase.table('chats').select('*').eq('user_id', user_id).execute()
-            if result.data:
-                conversation_history = result.data[0].get('messages', [])
-                chat_id = result.data[0]['id']
-            else:
-                conversation_history = []
-                chat_id = None
-        else:
-            user_chat = memory_get_chat(user_id)
-            conversation_history = user_chat.get('messages', [])
+        user_gender, bot_name = session['gender'], session['bot_name']
+        
+        # Get the recent conversation tail and the summary of everything before it,
+        # in a single round trip
+        with timed_stage('history'):
+            conversation_history, summary = STORAGE.get_turn_context(user_id)
+        HISTORY_MESSAGES.observe(len(conversation_history), 'send_message')
+        next_seq = conversation_history[-1]['seq'] + 1 if conversation_history else 1
         
         # Add user message
         user_message = {
             "role": "user",
             "content": message,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "seq": next_seq
         }
         conversation_history.append(user_message)
         
+        if stream:
+            response = Response(
+                stream_with_context(stream_message_events(
+                    user_id, user_message, conversation_history, user_gender, bot_name, summary, outcome
+                )),
+                mimetype='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no'  # Stop proxies from buffering the stream
+                }
+            )
+            # The lock is held until the stream is closed, even if the client disconnects early
+            response.call_on_close(lambda: finish_chat_turn(user_id, idempotency_slot, outcome))
+            handed_off = True
+            return response
+        
         # Get AI response with user context
-        ai_response = get_ai_response(message, conversation_history, user_gender, bot_name)
+        ai_response = get_ai_response(message, conversation_history, user_gender, bot_name, summary, user_id)
         
         # Add AI response
         assistant_message = {
             "role": "assistant",
             "content": ai_response,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "seq": user_message['seq'] + 1,
+            "connection_noise": is_connection_message(ai_response)
         }
         conversation_history.append(assistant_message)
         
         # Save to database
-        if USE_SUPABASE:
-            chat_data = {
-                "user_id": user_id,
-                "messages": conversation_history,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            if chat_id:
-                supabase.table('chats').update(chat_data).eq('id', chat_id).execute()
-            else:
-                supabase.table('chats').insert(chat_data).execute()
-        else:
-            memory_save_chat(user_id, conversation_history)
+        with timed_stage('save'):
+            STORAGE.append_messages(user_id, [user_message, assistant_message])
+            maybe_update_summary(user_id, bot_name, summary, conversation_history)
         
-        return jsonify({
+        outcome['result'] = {
             "response": ai_response,
-            "timestamp": assistant_message['timestamp']
-        }), 200
+            "timestamp": assistant_message['timestamp'],
+            "seq": assistant_message['seq']
+        }
+        return jsonify(outcome['result']), 200
+    
+    except GeminiBusyError as e:
+        # Nothing is saved, so the user can simply send the message again
+        log.warning("Message Error: Gemini busy - %s", e)
+        return jsonify({"error": RATE_LIMITED_MESSAGE}), 503
+    
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
     
     except Exception as e:
-        print(f"Message Error: {e}")
+        log.error("Message Error: %s", e, exc_info=True)
         return jsonify({"error": "Failed to process message"}), 500
+    
+    finally:
+        if not handed_off:
+            finish_chat_turn(user_id, idempotency_slot, outcome)
+
+
+def stream_message_events(user_id, user_message, conversation_history, user_gender, bot_name, summary, outcome):
+    """Stream the AI reply as SSE events and save the turn once it completes
+    
+    The final result is stored in `outcome['result']` for idempotent replays.
+    """
+    chunks = []
+    try:
+        for text in stream_ai_response(user_message['content'], conversation_history, user_gender, bot_name, summary, user_id):
+            chunks.append(text)
+            yield sse_event('chunk', {"text": text})
+        
+        ai_response = ''.join(chunks).strip()
+        assistant_message = {
+            "role": "assistant",
+            "content": ai_response,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "seq": user_message['seq'] + 1,
+            "connection_noise": is_connection_message(ai_response)
+        }
+        conversation_history.append(assistant_message)
+        
+        # Save to database once the full reply is known
+        with timed_stage('save'):
+            STORAGE.append_messages(user_id, [user_message, assistant_message])
+            maybe_update_summary(user_id, bot_name, summary, conversation_history)
+        
+        outcome['result'] = {
+            "response": ai_response,
+            "timestamp": assistant_message['timestamp'],
+            "seq": assistant_message['seq']
+        }
+        # Headers went out before the reply was generated, so the stage
+        # timings of a streamed turn travel in its last event
+        yield sse_event('done', {**outcome['result'], "server_timing": server_timing()})
+    
+    except GeminiBusyError as e:
+        log.warning("Message Stream Error: Gemini busy - %s", e)
+        yield sse_event('error', {"error": RATE_LIMITED_MESSAGE})
+    
+    except Exception as e:
+        log.error("Message Stream Error: %s", e, exc_info=True)
+        yield sse_event('error', {"error": "Failed to process message"})
 
 
 @app.route('/api/user/profile/<user_id>', methods=['PUT'])
 def update_user_profile(user_id):
     """Update user profile (gender and bot_name)"""
+    error = session_error(read_session_token(), user_id)
+    if error:
+        return error
+    
     try:
         # Handle request parsing
         if not request.is_json:
@@ -543,116 +2775,461 @@ def update_user_profile(user_id):
             if not bot_name:
                 return jsonify({"error": "Bot name cannot be empty"}), 400
         
-        if USE_SUPABASE:
-            try:
-                # Check if user exists
-                user_result = supabase.table('users').select('*').eq('id', user_id).execute()
-                if not user_result.data or len(user_result.data) == 0:
-                    return jsonify({"error": "User not found"}), 404
-                
-                # Prepare update data
-                update_data = {}
-                if gender is not None:
-                    update_data['gender'] = gender
-                if bot_name is not None:
-                    update_data['bot_name'] = bot_name
-                
-                # Update user
-                result = supabase.table('users').update(update_data).eq('id', user_id).execute()
-                if not result.data or len(result.data) == 0:
-                    return jsonify({"error": "Failed to update user profile"}), 500
-                
-                updated_user = result.data[0]
-            except Exception as db_error:
-                print(f"Database error during profile update: {db_error}")
-                print(traceback.format_exc())
-                error_str = str(db_error).lower()
-                if 'relation' in error_str or 'table' in error_str:
-                    return jsonify({"error": "Database table not found"}), 500
-                elif 'permission' in error_str:
-                    return jsonify({"error": "Database permission error"}), 500
-                else:
-                    raise
-        else:
-            # Memory storage
-            if user_id not in MEMORY_USERS:
-                return jsonify({"error": "User not found"}), 404
-            
-            # Update user data
-            if gender is not None:
-                MEMORY_USERS[user_id]['gender'] = gender
-            if bot_name is not None:
-                MEMORY_USERS[user_id]['bot_name'] = bot_name
-            
-            updated_user = MEMORY_USERS[user_id]
+        # Prepare update data
+        update_data = {}
+        if gender is not None:
+            update_data['gender'] = gender
+        if bot_name is not None:
+            update_data['bot_name'] = bot_name
         
+        try:
+            # A single update both changes the user and tells us whether it exists
+            with timed_stage('update'):
+                updated_user = STORAGE.update_user(user_id, **update_data)
+        except StorageUnavailable:
+            raise
+        except Exception as db_error:
+            log.error("Database error during profile update: %s", db_error, exc_info=True)
+            error_str = str(db_error).lower()
+            if 'relation' in error_str or 'table' in error_str:
+                return jsonify({"error": "Database table not found"}), 500
+            elif 'permission' in error_str:
+                return jsonify({"error": "Database permission error"}), 500
+            else:
+                raise
+        
+        if not updated_user:
+            return jsonify({"error": "User not found"}), 404
+        
+        gender = updated_user.get('gender', 'other')
+        bot_name = updated_user.get('bot_name', 'Virtual Partner')
         return jsonify({
             "message": "Profile updated successfully",
             "user": {
                 "id": user_id,
-                "username": updated_user.get('username') if not USE_SUPABASE else updated_user['username'],
-                "gender": updated_user.get('gender', 'other') if not USE_SUPABASE else updated_user.get('gender', 'other'),
-                "bot_name": updated_user.get('bot_name', 'Virtual Partner') if not USE_SUPABASE else updated_user.get('bot_name', 'Virtual Partner')
-            }
+                "username": updated_user.get('username'),
+                "gender": gender,
+                "bot_name": bot_name
+            },
+            # Chat turns take the persona from the token, so hand out one with the new persona
+            "token": issue_session_token(user_id, gender, bot_name)
         }), 200
     
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
+    
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"Profile Update Error: {e}")
-        print(f"Traceback: {error_details}")
+        log.error("Profile Update Error: %s", e, exc_info=True)
         error_msg = str(e) if os.getenv('FLASK_ENV') == 'development' else "Failed to update profile"
         return jsonify({"error": error_msg}), 500
 
 
+def normalize_timestamp(value):
+    """Parse an ISO 8601 timestamp into the UTC form messages are stored with, or None if invalid
+    
+    Stored timestamps compare as strings, so "...Z", other offsets and
+    missing fractions all have to be brought to the same shape first.
+    Timestamps without an offset are taken as UTC.
+    """
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+
+def history_etag(version):
+    """ETag for a history response: the chat version plus the query it answers"""
+    return f"{version}-{hashlib.sha1(request.query_string).hexdigest()[:12]}"
+
+
+def history_response(payload, version):
+    """History JSON (or a 304 when payload is None), validated by the chat version if known"""
+    response = jsonify(payload) if payload is not None else Response(status=304)
+    if version:
+        # Weak, since the body may be sent gzipped
+        response.set_etag(history_etag(version), weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/api/chat/history/<user_id>', methods=['GET'])
 def get_chat_history(user_id):
-    """Get user's chat history"""
+    """Get user's chat history
+    
+    With no query parameters the full history is returned. Otherwise one page
+    is returned, oldest first:
+    - ?limit=N - the newest N messages
+    - ?before=<seq>&limit=N - the N messages before seq (scrolling back)
+    - ?after=<seq> or ?since=<ISO timestamp> - only messages newer than that
+    
+    Paged responses include "has_more" (more messages exist past this page in
+    the direction being read) and "next_before" (cursor for the older page).
+    
+    Responses carry an ETag built from the chat version (the newest seq), so
+    If-None-Match is answered with 304 without loading any messages.
+    """
+    error = session_error(read_session_token(), user_id)
+    if error:
+        return error
+    
     try:
-        if USE_SUPABASE:
-            result = supabase.table('chats').select('*').eq('user_id', user_id).execute()
-            messages = result.data[0].get('messages', []) if result.data else []
-        else:
-            user_chat = memory_get_chat(user_id)
-            messages = user_chat.get('messages', [])
+        version = None
+        if request.if_none_match:
+            with timed_stage('version'):
+                version = STORAGE.get_chat_version(user_id)
+            if version and request.if_none_match.contains_weak(history_etag(version)):
+                return history_response(None, version)
+        
+        if not any(key in request.args for key in ('limit', 'before', 'after', 'since')):
+            with timed_stage('history'):
+                messages = STORAGE.get_all_messages(user_id)
+            HISTORY_MESSAGES.observe(len(messages), 'get_chat_history')
+            if version is None and messages:
+                version = messages[-1]['seq']
+            return history_response({"messages": messages}, version)
+        
+        try:
+            limit = int(request.args.get('limit', DEFAULT_HISTORY_PAGE_SIZE))
+            before = request.args.get('before', type=int)
+            after = request.args.get('after', type=int)
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        since = request.args.get('since')
+        if since is not None:
+            since = normalize_timestamp(since)
+            if since is None:
+                return jsonify({"error": "since must be an ISO 8601 timestamp"}), 400
+        
+        if limit < 1:
+            return jsonify({"error": "limit must be at least 1"}), 400
+        limit = min(limit, MAX_HISTORY_PAGE_SIZE)
+        if sum(cursor is not None for cursor in (before, after, since)) > 1:
+            return jsonify({"error": "Use only one of before, after or since"}), 400
+        if ('before' in request.args and before is None) or ('after' in request.args and after is None) or \
+                (before is not None and before < 0) or (after is not None and after < 0):
+            return jsonify({"error": "before and after must be message sequence numbers"}), 400
+        
+        with timed_stage('history'):
+            messages = STORAGE.get_messages_page(user_id, before, after, since, limit)
+        HISTORY_MESSAGES.observe(len(messages), 'get_chat_history')
+        has_more = len(messages) > limit
+        if has_more:
+            # The extra message is the one furthest from the cursor
+            messages = messages[:limit] if (after is not None or since is not None) else messages[1:]
         
-        return jsonify({"messages": messages}), 200
+        # A page that runs up to the newest message tells us the version for free
+        reaches_newest = before is None and not (has_more and (after is not None or since is not None))
+        if version is None and reaches_newest and messages:
+            version = messages[-1]['seq']
+        
+        return history_response({
+            "messages": messages,
+            "has_more": has_more,
+            "next_before": messages[0]['seq'] if messages else before
+        }, version)
+    
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
     
     except Exception as e:
-        print(f"History Error: {e}")
+        log.error("History Error: %s", e, exc_info=True)
         return jsonify({"error": "Failed to load chat history"}), 500
 
 
+@app.route('/api/chat/search', methods=['GET'])
+def search_chat():
+    """Search the signed-in user's messages
+    
+    - ?q=<words> - messages containing every word (the last one as a prefix),
+      best match first
+    - ?limit=N&offset=M - page through the hits
+    
+    Each hit has the message's seq, role and timestamp and a snippet with the
+    matched words wrapped in SNIPPET_MARK; the surrounding conversation can be
+    loaded from /api/chat/history with ?before/?after around the seq.
+    """
+    session = read_session_token()
+    error = session_error(session, request.args.get('userId'))
+    if error:
+        return error
+    user_id = session['uid']
+    
+    try:
+        terms = search_terms(request.args.get('q', ''))[:MAX_SEARCH_TERMS]
+        if not terms:
+            return jsonify({"error": "Search query must contain a word"}), 400
+        try:
+            limit = int(request.args.get('limit', DEFAULT_SEARCH_PAGE_SIZE))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({"error": "limit and offset must be integers"}), 400
+        if limit < 1 or offset < 0:
+            return jsonify({"error": "limit must be at least 1 and offset not negative"}), 400
+        limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+        
+        with timed_stage('search'):
+            hits = STORAGE.search_messages(user_id, terms, limit, offset)
+        has_more = len(hits) > limit
+        return jsonify({
+            "results": hits[:limit],
+            "has_more": has_more,
+            "next_offset": offset + limit if has_more else None
+        }), 200
+    
+    except StorageUnavailable as e:
+        return storage_unavailable_response(e)
+    
+    except Exception as e:
+        log.error("Search Error: %s", e, exc_info=True)
+        return jsonify({"error": "Failed to search chat history"}), 500
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint
+    
+    Stays 200 while storage is failing fast, with "status": "degraded", so the
+    process isn't restarted over an outage elsewhere.
+    """
+    storage_ok = STORAGE.healthy()
     return jsonify({
-        "status": "healthy",
-        "message": "Server is running",
-        "database": "Supabase" if USE_SUPABASE else "In-Memory",
-        "gemini_configured": bool(GEMINI_API_KEY)
+        "status": "healthy" if storage_ok else "degraded",
+        "message": "Server is running" if storage_ok else "Storage is unavailable",
+        "database": STORAGE.name,
+        "async_mode": ASYNC_MODE,
+        "gemini_configured": bool(GEMINI_API_KEY),
+        "storage": STORAGE.stats(),
+        "gemini_scheduler": GEMINI_SCHEDULER.stats(),
+        "startup": {
+            "ms": {name: round(seconds * 1000, 1) for name, seconds in STARTUP_SECONDS.items()},
+            # Initialized in a parent process (gunicorn --preload) and shared after fork
+            "preloaded": STARTUP_PID != os.getpid()
+        }
     }), 200
 
 
+def gauge_lines(name, help_text, value, metric_type='gauge'):
+    """Prometheus lines for a single unlabelled value read at scrape time"""
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {value}"]
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this process"""
+    lines = []
+    for metric in (REQUESTS_TOTAL, REQUEST_SECONDS, STAGE_SECONDS, GEMINI_TOKENS, HISTORY_MESSAGES, AUTH_THROTTLED):
+        lines.extend(metric.render())
+    
+    scheduler = GEMINI_SCHEDULER.stats()
+    lines.extend(gauge_lines('vp_gemini_rate_limited_total', 'Gemini calls answered with 429', scheduler['rate_limited'], 'counter'))
+    lines.extend(gauge_lines('vp_gemini_rejected_total', 'Gemini calls rejected by the local scheduler', scheduler['rejected'], 'counter'))
+    lines.extend(gauge_lines('vp_gemini_queue_depth', 'Chat turns waiting for a Gemini slot', scheduler['queued']))
+    
+    persona_cache = get_persona.cache_info()
+    lines.extend(gauge_lines('vp_persona_cache_hits_total', 'Persona prompt/model cache hits', persona_cache.hits, 'counter'))
+    lines.extend(gauge_lines('vp_persona_cache_misses_total', 'Persona prompt/model cache misses', persona_cache.misses, 'counter'))
+    
+    lines.extend([
+        '# HELP vp_startup_seconds Time spent in each startup phase of this process (or the preloading parent)',
+        '# TYPE vp_startup_seconds gauge'
+    ])
+    lines.extend(f'vp_startup_seconds{format_labels(("phase",), (name,))} {seconds}' for name, seconds in STARTUP_SECONDS.items())
+    
+    storage = STORAGE.stats()
+    write_queue = storage.get('write_queue')
+    if write_queue:
+        lines.extend(gauge_lines('vp_write_queue_depth', 'Chat messages waiting to be written', write_queue['depth']))
+    circuit = storage.get('circuit')
+    if circuit:
+        lines.extend(gauge_lines('vp_storage_circuit_open', 'Whether storage calls are failing fast (0 closed, 1 open or half-open)', int(circuit['state'] != 'closed')))
+        lines.extend(gauge_lines('vp_storage_circuit_rejected_total', 'Storage calls rejected by the open circuit', circuit['rejected'], 'counter'))
+        lines.extend(gauge_lines('vp_storage_timeouts_total', 'Storage calls that ran past their timeout', circuit['timeouts'], 'counter'))
+    
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# Frontend assets
+# index.html is the single source for the page. At startup (and again
+# whenever the file changes) its inline <style> and <script> are split
+# out into fingerprinted files and everything is precompressed with gzip, and
+# with brotli when that package is installed. Browsers cache the fingerprinted
+# files forever; the page itself is revalidated with its ETag, so a repeat
+# visit costs a 304.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PAGE_CACHE_CONTROL = 'no-cache'
+
+
+class StaticAsset:
+    """A file served from memory with precompressed variants"""
+    
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.fingerprint = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+    
+    def response(self, cache_control):
+        """Best encoding the client accepts, with an ETag and 304 handling"""
+        encodings = [encoding for encoding in ('br', 'gzip') if encoding in self.variants]
+        encoding = request.accept_encodings.best_match(encodings, default='identity')
+        response = Response(self.variants[encoding], mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = cache_control
+        # Each encoding is a different representation, so it gets its own ETag
+        response.set_etag(f"{self.fingerprint}-{encoding}")
+        return response.make_conditional(request)
+
+
+class Frontend:
+    """index.html with its inline CSS and JS split out into fingerprinted assets"""
+    
+    STYLE_RE = re.compile(r'<style>(.*?)</style>', re.S)
+    SCRIPT_RE = re.compile(r'<script>(.*?)</script>', re.S)
+    
+    def __init__(self, path):
+        self.path = path
+        self.page = None
+        self.assets = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+    
+    def current(self):
+        """Return self, rebuilt first if index.html changed since the last build"""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._build()
+                    self._mtime = mtime
+        return self
+    
+    def _build(self):
+        with open(self.path, encoding='utf-8') as f:
+            html = f.read()
+        assets = dict(self.assets)  # Keep serving old names to pages loaded before a rebuild
+        
+        def split_out(pattern, extension, mimetype, tag):
+            nonlocal html
+            match = pattern.search(html)
+            if match is None:
+                return
+            asset = StaticAsset(match.group(1).encode('utf-8'), mimetype)
+            name = f"app.{asset.fingerprint}.{extension}"
+            assets[name] = asset
+            html = html[:match.start()] + tag.format(name=name) + html[match.end():]
+        
+        split_out(self.STYLE_RE, 'css', 'text/css', '<link rel="stylesheet" href="/assets/{name}">')
+        split_out(self.SCRIPT_RE, 'js', 'application/javascript', '<script src="/assets/{name}"></script>')
+        self.page = StaticAsset(html.encode('utf-8'), 'text/html')
+        self.assets = assets
+        log.info("📦 Built frontend assets: %s", ', '.join(sorted(assets)) or 'none')
+
+
+FRONTEND = Frontend(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html'))
+
+
+@app.route('/assets/<name>')
+def frontend_asset(name):
+    """Serve a fingerprinted CSS/JS file split out of index.html"""
+    asset = FRONTEND.current().assets.get(name)
+    if asset is None:
+        return jsonify({"error": "Not found"}), 404
+    return asset.response(ASSET_CACHE_CONTROL)
+
+
 # Frontend routes (must be last to avoid catching API routes)
 @app.route('/')
 def index():
     """Serve the frontend"""
-    return send_from_directory('.', 'index.html')
+    return FRONTEND.current().page.response(PAGE_CACHE_CONTROL)
+
+
+# Startup
+# Importing this module only defines things; create_app() does the slow
+# work (Gemini SDK import, storage and Supabase client setup, frontend
+# build). gunicorn runs it once in the master with --preload, so forked
+# workers share the result copy-on-write instead of repeating it; plain
+# `gunicorn app:app` still works and initializes on the first request.
+STARTUP_SECONDS = {}  # phase -> seconds, filled in by create_app()
+STARTUP_PID = None
+_startup_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Record how long a startup phase takes in STARTUP_SECONDS"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_SECONDS[name] = time.perf_counter() - started
+
+
+def create_app():
+    """Initialize clients and storage once and return the Flask app"""
+    global STARTUP_PID
+    with _startup_lock:
+        if STARTUP_PID is not None:
+            return app
+        STARTUP_SECONDS['import'] = time.perf_counter() - IMPORT_STARTED
+        started = time.perf_counter()
+        with startup_phase('gemini'):
+            init_gemini()
+        with startup_phase('storage'):
+            init_supabase()
+            init_storage()
+        with startup_phase('frontend'):
+            FRONTEND.current()
+        STARTUP_SECONDS['init'] = time.perf_counter() - started
+        STARTUP_PID = os.getpid()
+        log.info("⏱️ Startup: %s", ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in STARTUP_SECONDS.items()),
+                 extra=log_fields(startup_ms={name: round(seconds * 1000, 1) for name, seconds in STARTUP_SECONDS.items()}))
+    return app
+
+
+@app.before_request
+def ensure_initialized():
+    """Initialize on the first request when the app wasn't created through create_app()"""
+    if STARTUP_PID is None:
+        create_app()
 
 
 if __name__ == '__main__':
+    create_app()
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-chats':
+        if isinstance(STORAGE, SupabaseBackend):
+            STORAGE.migrate_all_chat_blobs()
+        else:
+            print("⚠️ Supabase is not configured - nothing to migrate")
+        sys.exit(0)
+    
     print("\n" + "="*60)
     print("🚀 Virtual Partner Server Starting...")
     print("="*60)
     port = int(os.environ.get('PORT', 5000))
     print(f"📡 Server: http://localhost:{port}")
-    print(f"💾 Database: {'Supabase (Cloud)' if USE_SUPABASE else 'In-Memory (temporary)'}")
+    print(f"💾 Database: {STORAGE.name}")
     print(f"🤖 AI Model: Google Gemini")
     print("="*60 + "\n")
     
-    if not USE_SUPABASE:
+    if not USE_SUPABASE and LOCAL_STORAGE == 'memory':
         print("⚠️  WARNING: Using in-memory storage!")
         print("    All data will be lost when server restarts.")
-        print("    Add Supabase credentials to .env to persist data.\n")
+        print("    Unset LOCAL_STORAGE or add Supabase credentials to .env to persist data.\n")
     
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,489 @@
+"""Load test and latency benchmark for the Virtual Partner API
+
+Drives the app with many concurrent synthetic users against a fake Gemini
+model (configurable latency and streaming) and the fake Supabase client or
+local storage, then reports per-endpoint and per-stage latency percentiles
+and a throughput curve across concurrency levels.
+
+In-process, no server needed:
+    python benchmark.py --concurrency 1,4,16,64
+
+Against gunicorn (the server process installs the same fakes):
+    BENCH_GEMINI_LATENCY_MS=300 gunicorn -c gunicorn.conf.py 'benchmark:create_bench_app()'
+    python benchmark.py --url http://127.0.0.1:8000
+
+Runs use a fixed seed and a fixed number of requests per level, so results
+saved with --output can be compared with a later run using --baseline.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+REPLY_TEXT = (
+    "Hey! I was just thinking about you. How was your day, anything fun "
+    "happen? Tell me everything, I want to hear it all."
+)
+
+# Share of each synthetic user's requests that go to each endpoint
+REQUEST_MIX = (
+    ('message', 0.6),
+    ('history', 0.25),
+    ('login', 0.15),
+)
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Stand-in for genai.GenerativeModel that sleeps instead of calling Gemini
+
+    The first chunk arrives after `latency` seconds and each further chunk
+    after `chunk_delay`; non-streaming calls wait for the whole reply.
+    """
+
+    latency = 0.3
+    chunk_delay = 0.02
+    chunks = 8
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        words = REPLY_TEXT.split(' ')
+        size = math.ceil(len(words) / self.chunks)
+        pieces = [' '.join(words[i:i + size]) + ' ' for i in range(0, len(words), size)]
+        time.sleep(self.latency)
+        if stream:
+            return self._stream(pieces)
+        time.sleep(self.chunk_delay * (len(pieces) - 1))
+        return FakeChunk(''.join(pieces))
+
+    def _stream(self, pieces):
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(self.chunk_delay)
+            yield FakeChunk(piece)
+
+
+def create_bench_app(storage=None, gemini_latency_ms=None, chunk_ms=None, chunks=None):
+    """Create the app with a fake Gemini model and return the Flask app
+
+    Settings not passed in are read from BENCH_STORAGE (fake or local),
+    BENCH_GEMINI_LATENCY_MS, BENCH_CHUNK_MS and BENCH_CHUNKS, so this also
+    works as a gunicorn app factory.
+    """
+    storage = storage or os.getenv('BENCH_STORAGE', 'fake')
+    # Set before import; existing values win over .env in load_dotenv
+    os.environ['SUPABASE_URL'] = 'fake' if storage == 'fake' else ''
+    if storage != 'fake':
+        # A fresh SQLite file per run, not the developer's virtual_partner.db,
+        # so histories don't grow from run to run. Set SQLITE_PATH to share
+        # one between gunicorn workers that load the app themselves.
+        os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(prefix='vp-bench-'), 'bench.db'))
+    os.environ['GEMINI_API_KEY'] = 'benchmark'
+    # Gemini quotas are not what is being measured
+    os.environ.setdefault('GEMINI_RPM', '1000000')
+    os.environ.setdefault('GEMINI_BURST', '1000000')
+    os.environ.setdefault('GEMINI_QUEUE_SIZE', '100000')
+    # gunicorn runs with several workers need one signing key
+    os.environ.setdefault('SESSION_SECRET', 'benchmark-session-secret')
+    # Every synthetic user logs in from the same address
+    os.environ.setdefault('AUTH_IP_LIMIT', '1000000')
+
+    import app as app_module
+    flask_app = app_module.create_app()
+
+    FakeGenerativeModel.latency = float(gemini_latency_ms if gemini_latency_ms is not None else os.getenv('BENCH_GEMINI_LATENCY_MS', '300')) / 1000
+    FakeGenerativeModel.chunk_delay = float(chunk_ms if chunk_ms is not None else os.getenv('BENCH_CHUNK_MS', '20')) / 1000
+    FakeGenerativeModel.chunks = max(1, int(chunks if chunks is not None else os.getenv('BENCH_CHUNKS', '8')))
+    app_module.genai.GenerativeModel = FakeGenerativeModel
+    app_module.get_persona.cache_clear()
+    app_module.get_summary_model.cache_clear()
+    return flask_app
+
+
+class Result:
+    """Outcome of one request as seen by the client"""
+
+    def __init__(self, status, ttfb, total, body, server_timing):
+        self.status = status
+        self.ttfb = ttfb
+        self.total = total
+        self.body = body
+        self.server_timing = server_timing
+
+    def json(self):
+        return json.loads(self.body)
+
+    def stages(self):
+        """Parse the Server-Timing header into {stage: seconds}
+
+        Streamed turns send their full timings in the final `done` event.
+        """
+        server_timing = self.server_timing
+        _, found, done = self.body.rpartition(b'event: done\ndata: ')
+        if found:
+            server_timing = json.loads(done.split(b'\n', 1)[0]).get('server_timing') or server_timing
+        stages = {}
+        for part in (server_timing or '').split(','):
+            name, _, duration = part.strip().partition(';dur=')
+            if name and duration:
+                stages[name] = float(duration) / 1000
+        return stages
+
+
+class InProcessClient:
+    """Calls the Flask app directly with one test client per thread"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers, buffered=False)
+        ttfb = None
+        parts = []
+        try:
+            for part in response.iter_encoded():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                parts.append(part)
+        finally:
+            # Streamed chat turns are only finished once the response is closed
+            response.close()
+        total = time.perf_counter() - start
+        return Result(response.status_code, ttfb or total, total, b''.join(parts), response.headers.get('Server-Timing'))
+
+
+class HTTPClient:
+    """Calls a running server over keep-alive HTTP connections, one per thread"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.connection_class(self.host, self.port, timeout=120)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        payload = json.dumps(body) if body is not None else None
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            ttfb = None
+            parts = []
+            while True:
+                part = response.read1(65536)
+                if not part:
+                    break
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                parts.append(part)
+            # read1() leaves the response open at the end of a sized body
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.local.connection = None
+            raise
+        total = time.perf_counter() - start
+        return Result(response.status, ttfb or total, total, b''.join(parts), response.getheader('Server-Timing'))
+
+
+class LatencyStats:
+    """Latency samples per endpoint and per (endpoint, stage)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.ttfb = {}
+        self.stages = {}
+        self.errors = {}
+
+    def record(self, endpoint, result):
+        with self.lock:
+            if result is None or result.status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                return
+            self.latency.setdefault(endpoint, []).append(result.total)
+            self.ttfb.setdefault(endpoint, []).append(result.ttfb)
+            for stage, seconds in result.stages().items():
+                self.stages.setdefault(endpoint, {}).setdefault(stage, []).append(seconds)
+
+    def report(self):
+        return {
+            endpoint: {
+                **summarize(samples),
+                "errors": self.errors.get(endpoint, 0),
+                "ttfb": summarize(self.ttfb[endpoint]),
+                "stages": {stage: summarize(values) for stage, values in sorted(self.stages.get(endpoint, {}).items())}
+            }
+            for endpoint, samples in sorted(self.latency.items())
+        } | {
+            endpoint: {"count": 0, "errors": errors}
+            for endpoint, errors in self.errors.items() if endpoint not in self.latency
+        }
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    """Count, mean and p50/p90/p99 in milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50_ms": round(percentile(ordered, 0.5) * 1000, 2),
+        "p90_ms": round(percentile(ordered, 0.9) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+    }
+
+
+def register_users(client, count, password):
+    """Create `count` benchmark accounts and return their [id, username, session token]"""
+    run_id = uuid.uuid4().hex[:8]
+    users = []
+    for i in range(count):
+        username = f"bench_{run_id}_{i}"
+        result = client.request('POST', '/api/auth/register', {
+            "username": username,
+            "password": password,
+            "gender": random.Random(i).choice(['male', 'female', 'other']),
+            "bot_name": "Bench"
+        })
+        if result.status != 201:
+            raise RuntimeError(f"Registering {username} failed with HTTP {result.status}: {result.body[:200]!r}")
+        data = result.json()
+        users.append([data['user']['id'], username, data['token']])
+    return users
+
+
+def pick_action(rng):
+    roll = rng.random()
+    for action, share in REQUEST_MIX:
+        if roll < share:
+            return action
+        roll -= share
+    return REQUEST_MIX[-1][0]
+
+
+def run_user(client, user, password, requests, seed, stream_ratio, stats):
+    """One synthetic user issuing `requests` requests back to back"""
+    user_id, username, _ = user
+    rng = random.Random(seed)
+    for i in range(requests):
+        action = pick_action(rng)
+        if action == 'message':
+            stream = rng.random() < stream_ratio
+            endpoint = 'message_stream' if stream else 'message'
+            method, path, body = 'POST', '/api/chat/message', {
+                "message": f"message {i}: how are you doing today?",
+                "stream": stream
+            }
+        elif action == 'history':
+            endpoint = 'history'
+            method, path, body = 'GET', f'/api/chat/history/{user_id}?limit=50', None
+        else:
+            endpoint = 'login'
+            method, path, body = 'POST', '/api/auth/login', {"username": username, "password": password}
+        try:
+            result = client.request(method, path, body, token=user[2])
+            if endpoint == 'message_stream' and b'event: done' not in result.body:
+                result.status = 599
+            elif endpoint == 'login' and result.status == 200:
+                user[2] = result.json()['token']
+        except Exception as e:
+            print(f"⚠️ {endpoint} request failed: {e}", file=sys.stderr)
+            result = None
+        stats.record(endpoint, result)
+
+
+def storage_round_trips(client):
+    """Round trips per Flask endpoint reported by the fake Supabase client, if in use"""
+    try:
+        health = client.request('GET', '/api/health').json()
+    except Exception:
+        return {}
+    return ((health.get('storage') or {}).get('client') or {}).get('round_trips') or {}
+
+
+# Benchmark endpoint names -> the Flask endpoint that serves them
+FLASK_ENDPOINTS = {
+    'message': 'send_message',
+    'message_stream': 'send_message',
+    'history': 'get_chat_history',
+    'login': 'login',
+}
+
+
+def run_level(client, users, concurrency, total_requests, password, seed, stream_ratio):
+    """Run one concurrency level and return its report"""
+    stats = LatencyStats()
+    per_user = math.ceil(total_requests / concurrency)
+    before = storage_round_trips(client)
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(client, users[i], password, per_user, seed * 1000 + i, stream_ratio, stats),
+            daemon=True
+        )
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    after = storage_round_trips(client)
+
+    endpoints = stats.report()
+    completed = sum(report.get('count', 0) for report in endpoints.values())
+    if after:
+        calls = {}
+        for endpoint, report in endpoints.items():
+            flask_endpoint = FLASK_ENDPOINTS[endpoint]
+            calls[flask_endpoint] = calls.get(flask_endpoint, 0) + report.get('count', 0) + report.get('errors', 0)
+        for endpoint, report in endpoints.items():
+            flask_endpoint = FLASK_ENDPOINTS[endpoint]
+            trips = after.get(flask_endpoint, 0) - before.get(flask_endpoint, 0)
+            if calls[flask_endpoint]:
+                report['db_round_trips_per_request'] = round(trips / calls[flask_endpoint], 2)
+    return {
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": sum(report.get('errors', 0) for report in endpoints.values()),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "endpoints": endpoints
+    }
+
+
+def print_level(level, out):
+    print(f"\n=== concurrency {level['concurrency']}: {level['requests']} requests in {level['seconds']}s "
+          f"({level['throughput_rps']} req/s, {level['errors']} errors) ===", file=out)
+    print(f"{'endpoint / stage':<28}{'count':>7}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}  ms", file=out)
+    for endpoint, report in level['endpoints'].items():
+        if not report.get('count'):
+            print(f"{endpoint:<28}{0:>7}   (all {report['errors']} failed)", file=out)
+            continue
+        extra = f"  errors={report['errors']}" if report['errors'] else ''
+        if 'db_round_trips_per_request' in report:
+            extra += f"  db_round_trips/req={report['db_round_trips_per_request']}"
+        print(format_row(endpoint, report) + extra, file=out)
+        if endpoint == 'message_stream':
+            print(format_row('  first byte', report['ttfb']), file=out)
+        for stage, stage_report in report['stages'].items():
+            print(format_row(f"  {stage}", stage_report), file=out)
+
+
+def format_row(label, report):
+    return (f"{label:<28}{report['count']:>7}{report['mean_ms']:>10.1f}"
+            f"{report['p50_ms']:>10.1f}{report['p90_ms']:>10.1f}{report['p99_ms']:>10.1f}")
+
+
+def print_curve(levels, out, baseline=None):
+    """Throughput and chat latency per concurrency level, with deltas against a baseline run"""
+    baseline_levels = {level['concurrency']: level for level in (baseline or {}).get('levels', [])}
+    print("\n=== throughput vs concurrency ===", file=out)
+    print(f"{'concurrency':>11}{'req/s':>10}{'message p50':>13}{'message p99':>13}", file=out)
+    for level in levels:
+        message = level['endpoints'].get('message', {})
+        row = (f"{level['concurrency']:>11}{level['throughput_rps']:>10.1f}"
+               f"{message.get('p50_ms', float('nan')):>13.1f}{message.get('p99_ms', float('nan')):>13.1f}")
+        old = baseline_levels.get(level['concurrency'])
+        if old:
+            old_message = old['endpoints'].get('message', {})
+            row += f"   vs baseline: req/s {change(old['throughput_rps'], level['throughput_rps'])}"
+            if old_message.get('p99_ms') and message.get('p99_ms'):
+                row += f", message p99 {change(old_message['p99_ms'], message['p99_ms'])}"
+        print(row, file=out)
+
+
+def change(old, new):
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help="Benchmark a running server instead of the app in-process")
+    parser.add_argument('--concurrency', default='1,4,16,64', help="Comma-separated concurrent users per level")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument('--stream-ratio', type=float, default=0.5, help="Share of chat messages sent with streaming")
+    parser.add_argument('--storage', choices=['fake', 'local'], default='fake', help="In-process storage: fake Supabase or local storage")
+    parser.add_argument('--gemini-latency-ms', type=float, default=300, help="In-process fake Gemini time to first chunk")
+    parser.add_argument('--chunk-ms', type=float, default=20, help="In-process fake Gemini delay between chunks")
+    parser.add_argument('--chunks', type=int, default=8, help="In-process fake Gemini chunks per reply")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the request mix")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's own log output (in-process)")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    levels = [int(level) for level in args.concurrency.split(',')]
+    password = 'bench-password'
+
+    if args.url:
+        client = HTTPClient(args.url)
+        target = args.url
+    else:
+        if not args.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        flask_app = create_bench_app(args.storage, args.gemini_latency_ms, args.chunk_ms, args.chunks)
+        client = InProcessClient(flask_app)
+        target = f"in-process ({args.storage} storage, Gemini {args.gemini_latency_ms:g}ms + {args.chunks}x{args.chunk_ms:g}ms)"
+
+    print(f"Benchmarking {target}: levels {levels}, {args.requests} requests each", file=out)
+    users = register_users(client, max(levels), password)
+
+    results = []
+    for concurrency in levels:
+        level = run_level(client, users, concurrency, args.requests, password, args.seed, args.stream_ratio)
+        results.append(level)
+        print_level(level, out)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_curve(results, out, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"target": target, "args": vars(args), "levels": results}, f, indent=2)
+        print(f"\nResults written to {args.output}", file=out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os
+
+# Tests import app directly, which needs a signing key outside `python app.py`
+os.environ.setdefault('SESSION_SECRET', 'test-session-secret')
+# Keep test data out of the developer's virtual_partner.db
+os.environ.setdefault('LOCAL_STORAGE', 'memory')
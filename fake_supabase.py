@@ -0,0 +1,295 @@
+"""Offline stand-in for the Supabase client
+
+Used with SUPABASE_URL=fake to benchmark the Supabase code paths without a
+project. It keeps tables in memory, supports the query builder calls the app
+makes, adds a fixed latency to every round trip and counts round trips per
+endpoint.
+"""
+import re
+import threading
+import time
+import uuid
+
+from flask import request, has_request_context
+
+from search import MessageIndex, make_snippet
+
+
+class FakeSupabaseResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeSupabaseError(Exception):
+    """Error answered by the fake server; carries a Postgres error code like PostgREST's APIError"""
+    
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeSupabaseQuery:
+    """Chainable query on one FakeSupabaseClient table"""
+    
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = 'select'
+        self.columns = None
+        self.payload = None
+        self.on_conflict = None
+        self.ignore_duplicates = False
+        self.filters = []
+        self.order_by = None
+        self.start = 0
+        self.count = None
+        self.embeds = {}  # embedded table -> {'columns', 'order_by', 'count'}
+    
+    def select(self, columns='*'):
+        self.action = 'select'
+        # Embedded resources look like "chat_messages(seq, role)"
+        for table, embedded in re.findall(r'(\w+)\s*\(([^)]*)\)', columns):
+            self.embeds[table] = {
+                'columns': [column.strip() for column in embedded.split(',')],
+                'order_by': None,
+                'count': None
+            }
+        columns = re.sub(r'\w+\s*\([^)]*\)', '', columns)
+        if columns.strip() != '*':
+            self.columns = [column.strip() for column in columns.split(',') if column.strip()]
+        return self
+    
+    def insert(self, rows):
+        self.action = 'insert'
+        self.payload = rows if isinstance(rows, list) else [rows]
+        return self
+    
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.action = 'upsert'
+        self.payload = rows if isinstance(rows, list) else [rows]
+        self.on_conflict = on_conflict
+        self.ignore_duplicates = ignore_duplicates
+        return self
+    
+    def update(self, fields):
+        self.action = 'update'
+        self.payload = fields
+        return self
+    
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+    
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+    
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+    
+    def order(self, column, desc=False, foreign_table=None):
+        if foreign_table:
+            self.embeds[foreign_table]['order_by'] = (column, desc)
+        else:
+            self.order_by = (column, desc)
+        return self
+    
+    def limit(self, count, foreign_table=None):
+        if foreign_table:
+            self.embeds[foreign_table]['count'] = count
+        else:
+            self.count = count
+        return self
+    
+    def range(self, start, end):
+        self.start = start
+        self.count = end - start + 1
+        return self
+    
+    def execute(self):
+        self.client.round_trip()
+        with self.client.lock:
+            return FakeSupabaseResponse(getattr(self, f'_{self.action}')())
+    
+    def _matches(self):
+        return [row for row in self.client.tables.setdefault(self.table, []) if all(f(row) for f in self.filters)]
+    
+    def _select(self):
+        rows = self._matches()
+        if self.order_by:
+            column, desc = self.order_by
+            rows.sort(key=lambda row: row.get(column), reverse=desc)
+        rows = rows[self.start:]
+        if self.count is not None:
+            rows = rows[:self.count]
+        results = []
+        for row in rows:
+            result = {column: row.get(column) for column in self.columns} if self.columns is not None else dict(row)
+            for table, embed in self.embeds.items():
+                result[table] = self._embedded(table, embed, row)
+            results.append(result)
+        return results
+    
+    def _embedded(self, table, embed, parent):
+        """Rows of `table` referencing `parent` through its foreign key"""
+        column = self.client.FOREIGN_KEYS[table]
+        rows = [row for row in self.client.tables.get(table, []) if row.get(column) == parent.get('id')]
+        if embed['order_by']:
+            order_column, desc = embed['order_by']
+            rows.sort(key=lambda row: row.get(order_column), reverse=desc)
+        if embed['count'] is not None:
+            rows = rows[:embed['count']]
+        rows = [{column: row.get(column) for column in embed['columns']} for row in rows]
+        if self.client.KEYS[table] == (column,):
+            # One-to-one relationships embed a single object (or null), like PostgREST
+            return rows[0] if rows else None
+        return rows
+    
+    def _key(self, row, columns):
+        return tuple(row.get(column) for column in columns)
+    
+    def _insert(self):
+        rows = self.client.tables.setdefault(self.table, [])
+        keys = self.client.KEYS.get(self.table, ('id',))
+        existing = {self._key(row, keys) for row in rows}
+        new_rows = []
+        for fields in self.payload:
+            row = dict(fields)
+            if 'id' in keys and row.get('id') is None:
+                row['id'] = str(uuid.uuid4())
+            for unique in self.client.UNIQUE.get(self.table, ()):
+                if any(other.get(unique) == row.get(unique) for other in rows):
+                    raise FakeSupabaseError(f'duplicate key value violates unique constraint "{self.table}_{unique}_key"', '23505')
+            if self._key(row, keys) in existing:
+                raise FakeSupabaseError(f'duplicate key value violates unique constraint "{self.table}_pkey"', '23505')
+            existing.add(self._key(row, keys))
+            new_rows.append(row)
+        rows.extend(new_rows)
+        if self.table == 'chat_messages':
+            self.client._index_messages(new_rows)
+        return [dict(row) for row in new_rows]
+    
+    def _upsert(self):
+        rows = self.client.tables.setdefault(self.table, [])
+        if self.on_conflict:
+            keys = tuple(column.strip() for column in self.on_conflict.split(','))
+        else:
+            keys = self.client.KEYS.get(self.table, ('id',))
+        by_key = {self._key(row, keys): row for row in rows}
+        written = []
+        new_rows = []
+        for fields in self.payload:
+            row = by_key.get(self._key(fields, keys))
+            if row is None:
+                row = dict(fields)
+                rows.append(row)
+                by_key[self._key(row, keys)] = row
+                new_rows.append(row)
+            elif self.ignore_duplicates:
+                continue
+            else:
+                row.update(fields)
+            written.append(dict(row))
+        if self.table == 'chat_messages':
+            self.client._index_messages(new_rows)
+        return written
+    
+    def _update(self):
+        rows = self._matches()
+        for row in rows:
+            row.update(self.payload)
+        return [dict(row) for row in rows]
+
+
+class FakeSupabaseRPC:
+    """Call of a database function on a FakeSupabaseClient"""
+    
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params
+    
+    def execute(self):
+        self.client.round_trip()
+        with self.client.lock:
+            return FakeSupabaseResponse(getattr(self.client, f'_rpc_{self.name}')(**self.params))
+
+
+class FakeSupabaseClient:
+    """In-memory Supabase client with injected per-request latency
+    
+    Setting `outage` makes every round trip fail with a connection error,
+    to exercise the circuit breaker.
+    """
+    
+    # Primary and unique keys of the tables the app uses
+    KEYS = {
+        'users': ('id',),
+        'chats': ('id',),
+        'chat_messages': ('user_id', 'seq'),
+        'chat_summaries': ('user_id',),
+    }
+    UNIQUE = {'users': ('username',)}
+    # Columns referencing users.id, for embedded selects
+    FOREIGN_KEYS = {'chats': 'user_id', 'chat_messages': 'user_id', 'chat_summaries': 'user_id'}
+    
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.round_trips = {}
+        self.outage = False
+        # user_id -> (MessageIndex, {seq: row}), kept up to date by inserts
+        # and upserts like the Postgres full-text index
+        self.message_indexes = {}
+    
+    def table(self, name):
+        return FakeSupabaseQuery(self, name)
+    
+    def rpc(self, name, params):
+        return FakeSupabaseRPC(self, name, params)
+    
+    def _index_messages(self, rows):
+        """Add new chat_messages rows to their users' search indexes"""
+        for row in rows:
+            if row.get('connection_noise'):
+                continue
+            index, by_seq = self.message_indexes.setdefault(row['user_id'], (MessageIndex(), {}))
+            index.add(row['seq'], row['content'])
+            by_seq[row['seq']] = row
+    
+    def _rpc_search_chat_messages(self, p_user_id, p_query, p_limit, p_offset):
+        # Same results as the Postgres function, from the user's index
+        terms = [term.removesuffix(':*') for term in p_query.split(' & ')]
+        if p_user_id not in self.message_indexes:
+            return []
+        index, rows = self.message_indexes[p_user_id]
+        return [
+            {
+                "seq": seq,
+                "role": rows[seq]['role'],
+                "timestamp": rows[seq]['timestamp'],
+                "snippet": make_snippet(rows[seq]['content'], terms)
+            }
+            for seq in index.search(terms)[p_offset:p_offset + p_limit]
+        ]
+    
+    def round_trip(self):
+        """Count one round trip against the current endpoint and wait out the latency"""
+        endpoint = (request.endpoint or 'unknown') if has_request_context() else 'background'
+        with self.lock:
+            self.round_trips[endpoint] = self.round_trips.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.outage:
+            raise ConnectionError("Fake Supabase outage")
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "fake": True,
+                "latency_ms": self.latency * 1000,
+                "round_trips": dict(self.round_trips),
+                "rows": {name: len(rows) for name, rows in self.tables.items()}
+            }
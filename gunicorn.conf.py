@@ -0,0 +1,26 @@
+# Gunicorn settings picked up automatically from the project root.
+# Command-line flags in the Procfile still take precedence over these.
+import os
+
+# Set GUNICORN_ASYNC=1 to serve with gevent instead of the default sync/thread
+# workers. Each request then runs in a greenlet and yields while it waits on
+# Gemini or Supabase, so one process can hold hundreds of in-flight chats
+# instead of being limited to --threads.
+ASYNC = os.getenv('GUNICORN_ASYNC', '').lower() in ('1', 'true', 'yes')
+if ASYNC:
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '500'))
+
+# Create the app once in the master (with 'app:create_app()') and fork the
+# workers from it, so the Gemini SDK import and client setup are shared
+# copy-on-write instead of repeated in every worker. gevent patches the
+# standard library inside each worker after the fork, so async workers
+# load the app themselves.
+preload_app = not ASYNC
+
+
+def worker_exit(server, worker):
+    """Write out queued chat messages before the worker goes away"""
+    import app
+    if app.STORAGE is not None:
+        app.STORAGE.flush()
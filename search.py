@@ -0,0 +1,108 @@
+"""Chat search helpers shared by the app and the fake Supabase client
+
+Every backend keeps an inverted index that is updated as messages are
+appended (FTS5 in SQLite, a tsvector GIN index in Supabase, MessageIndex in
+memory), so a search only reads the posting lists of its terms. A query
+matches messages containing every term, the last one as a prefix so results
+follow the user's typing. Snippets wrap matched words in SNIPPET_MARK.
+"""
+import bisect
+import math
+import re
+
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+SNIPPET_MARK = '**'
+SNIPPET_WORDS = 12
+
+
+def search_terms(text):
+    """Lowercased word tokens, as indexed and searched"""
+    return SEARCH_TOKEN_RE.findall(text.lower())
+
+
+def term_matches(word, terms):
+    """Whether a lowercased word matches the query terms (the last one as a prefix)"""
+    return word in terms[:-1] or word.startswith(terms[-1])
+
+
+def make_snippet(content, terms, words=SNIPPET_WORDS):
+    """Excerpt of content around the first match, with matched words marked"""
+    tokens = list(SEARCH_TOKEN_RE.finditer(content))
+    first = next((i for i, token in enumerate(tokens) if term_matches(token.group().lower(), terms)), 0)
+    start = max(0, min(first - words // 4, len(tokens) - words))
+    window = tokens[start:start + words]
+    if not window:
+        return content
+    parts = ['…' if start > 0 else '']
+    position = window[0].start()
+    for token in window:
+        parts.append(content[position:token.start()])
+        if term_matches(token.group().lower(), terms):
+            parts.append(f"{SNIPPET_MARK}{token.group()}{SNIPPET_MARK}")
+        else:
+            parts.append(token.group())
+        position = token.end()
+    if start + words < len(tokens):
+        parts.append('…')
+    else:
+        parts.append(content[position:])
+    return ''.join(parts)
+
+
+class MessageIndex:
+    """Inverted index over one user's messages, ranked with BM25"""
+    
+    K1 = 1.2
+    B = 0.75
+    
+    def __init__(self):
+        self.postings = {}  # term -> {seq: occurrences}
+        self.vocabulary = []  # sorted terms, for prefix lookups
+        self.lengths = {}  # seq -> number of terms
+        self.total_length = 0  # sum of lengths, for BM25's average length
+    
+    def add(self, seq, content):
+        """Index one message"""
+        terms = search_terms(content)
+        self.total_length += len(terms)
+        self.lengths[seq] = len(terms)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.vocabulary, term)
+            postings[seq] = postings.get(seq, 0) + 1
+    
+    def _expand(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\U0010ffff')
+        return self.vocabulary[start:end]
+    
+    def search(self, terms):
+        """Seqs of messages matching every term, best match first"""
+        groups = [[term] if term in self.postings else [] for term in terms[:-1]]
+        groups.append(self._expand(terms[-1]))
+        if not all(groups):
+            return []
+        
+        # Start from the rarest group so the candidate set stays small
+        groups.sort(key=lambda group: sum(len(self.postings[term]) for term in group))
+        candidates = set().union(*(self.postings[term] for term in groups[0]))
+        for group in groups[1:]:
+            candidates &= set().union(*(self.postings[term] for term in group))
+        
+        total = len(self.lengths)
+        average_length = self.total_length / total
+        scores = {}
+        for seq in candidates:
+            norm = self.K1 * (1 - self.B + self.B * self.lengths[seq] / average_length)
+            score = 0.0
+            for group in groups:
+                for term in group:
+                    occurrences = self.postings[term].get(seq)
+                    if occurrences:
+                        df = len(self.postings[term])
+                        idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                        score += idf * occurrences * (self.K1 + 1) / (occurrences + norm)
+            scores[seq] = score
+        return sorted(candidates, key=lambda seq: (-scores[seq], -seq))
@@ -0,0 +1,132 @@
+"""Tests for the HTTP API against both local storage backends
+
+Run with: python -m pytest -q
+"""
+import pytest
+from itsdangerous import URLSafeTimedSerializer
+
+import app
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def client(request, tmp_path, monkeypatch):
+    app.create_app()
+    if request.param == 'memory':
+        users, chats = app.MemoryUserStore(), app.MemoryChatStore()
+    else:
+        db = app.SQLiteDatabase(str(tmp_path / 'test.db'))
+        users, chats = app.SQLiteUserStore(db), app.SQLiteChatStore(db)
+    monkeypatch.setattr(app, 'STORAGE', app.LocalBackend(users, chats, request.param))
+    monkeypatch.setattr(app, 'AUTH_IP_THROTTLE_ENABLED', False)
+    return app.app.test_client()
+
+
+def register(client, username='alice', password='secret'):
+    response = client.post('/api/auth/register', json={'username': username, 'password': password})
+    assert response.status_code == 201
+    body = response.get_json()
+    return body['user']['id'], {'Authorization': f"Bearer {body['token']}"}
+
+
+def add_messages(user_id, count):
+    app.STORAGE.append_messages(user_id, [
+        {'seq': seq, 'role': 'user', 'content': f'message {seq}', 'timestamp': f'2024-01-01T00:00:{seq:02d}.500000+00:00'}
+        for seq in range(1, count + 1)
+    ])
+
+
+@pytest.mark.parametrize('query', ['after=-2&limit=2', 'before=-1', 'after=x'])
+def test_history_rejects_bad_cursors(client, query):
+    user_id, headers = register(client)
+    add_messages(user_id, 3)
+    response = client.get(f'/api/chat/history/{user_id}?{query}', headers=headers)
+    assert response.status_code == 400
+
+
+def test_history_after_cursor_is_the_same_on_every_backend(client):
+    user_id, headers = register(client)
+    add_messages(user_id, 5)
+    response = client.get(f'/api/chat/history/{user_id}?after=0&limit=2', headers=headers)
+    body = response.get_json()
+    assert [msg['seq'] for msg in body['messages']] == [1, 2]
+    assert body['has_more'] is True
+
+
+@pytest.mark.parametrize('since', [
+    '2024-01-01T00:00:02.5Z',
+    '2024-01-01T01:00:02.500000+01:00',
+    '2024-01-01T00:00:02.500000',
+])
+def test_history_since_accepts_any_iso_form_of_the_same_instant(client, since):
+    user_id, headers = register(client)
+    add_messages(user_id, 4)
+    response = client.get(f'/api/chat/history/{user_id}', query_string={'since': since}, headers=headers)
+    assert response.status_code == 200
+    assert [msg['seq'] for msg in response.get_json()['messages']] == [3, 4]
+
+
+@pytest.mark.parametrize('since', ['yesterday', '', '2024-13-01'])
+def test_history_rejects_a_bad_since(client, since):
+    user_id, headers = register(client)
+    response = client.get(f'/api/chat/history/{user_id}', query_string={'since': since}, headers=headers)
+    assert response.status_code == 400
+
+
+def test_normalize_timestamp():
+    assert app.normalize_timestamp('2024-01-01T00:00:00Z') == '2024-01-01T00:00:00.000000+00:00'
+    assert app.normalize_timestamp('2024-01-01') == '2024-01-01T00:00:00.000000+00:00'
+    assert app.normalize_timestamp('2024-01-01T02:00:00+02:00') == '2024-01-01T00:00:00.000000+00:00'
+    assert app.normalize_timestamp('not a time') is None
+
+
+@pytest.mark.parametrize('credentials', [
+    {'username': ['alice'], 'password': 'secret'},
+    {'username': 42, 'password': 'secret'},
+    {'username': 'alice', 'password': {'x': 1}},
+])
+def test_login_with_non_string_credentials_is_rejected(client, credentials):
+    register(client)
+    response = client.post('/api/auth/login', json=credentials)
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize('authorization', [None, '', 'Bearer', 'Basic abc', 'Bearer not-a-token'])
+def test_history_without_a_valid_session_is_401(client, authorization):
+    user_id, _ = register(client)
+    headers = {'Authorization': authorization} if authorization is not None else {}
+    response = client.get(f'/api/chat/history/{user_id}', headers=headers)
+    assert response.status_code == 401
+
+
+def test_tampered_session_token_is_rejected(client):
+    user_id, _ = register(client)
+    _, other_headers = register(client, 'bob')
+    # Swap in a payload naming alice, keeping the timestamp and signature of bob's token
+    _, _, stamp_and_signature = other_headers['Authorization'].removeprefix('Bearer ').partition('.')
+    forged = app.SESSION_SERIALIZER.dumps({'uid': user_id, 'gender': 'other', 'bot_name': 'x'}).partition('.')[0]
+    response = client.get(f'/api/chat/history/{user_id}', headers={'Authorization': f'Bearer {forged}.{stamp_and_signature}'})
+    assert response.status_code == 401
+
+
+def test_session_token_signed_with_another_key_is_rejected(client):
+    user_id, _ = register(client)
+    token = URLSafeTimedSerializer('some-other-key', salt='session').dumps({'uid': user_id})
+    response = client.get(f'/api/chat/history/{user_id}', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 401
+
+
+def test_expired_session_token_is_rejected(client, monkeypatch):
+    user_id, headers = register(client)
+    assert client.get(f'/api/chat/history/{user_id}', headers=headers).status_code == 200
+    monkeypatch.setattr(app, 'SESSION_TTL', -1)
+    assert client.get(f'/api/chat/history/{user_id}', headers=headers).status_code == 401
+
+
+def test_session_cannot_act_for_another_user(client):
+    _, headers = register(client)
+    other_id, _ = register(client, 'bob')
+    assert client.get(f'/api/chat/history/{other_id}', headers=headers).status_code == 403
+    response = client.put(f'/api/user/profile/{other_id}', json={'gender': 'female'}, headers=headers)
+    assert response.status_code == 403
+    response = client.post('/api/chat/message', json={'userId': other_id, 'message': 'hi'}, headers=headers)
+    assert response.status_code == 403
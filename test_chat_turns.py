@@ -0,0 +1,99 @@
+"""Tests for per-user chat locks and idempotent chat turns
+
+Run with: python -m pytest -q
+"""
+import threading
+import time
+
+import app
+
+
+def test_keyed_lock_times_out_while_held():
+    locks = app.KeyedLocks()
+    assert locks.acquire('u1')
+    assert locks.acquire('u1', timeout=0.05) is False
+    # Other keys are independent
+    assert locks.acquire('u2', timeout=0.05)
+    locks.release('u2')
+    locks.release('u1')
+    assert locks.acquire('u1', timeout=0.05)
+    locks.release('u1')
+
+
+def test_keyed_locks_are_discarded_once_unused():
+    locks = app.KeyedLocks()
+    assert locks.acquire('u1')
+    assert locks.acquire('u1', timeout=0.01) is False
+    assert locks._locks['u1'][1] == 1
+    locks.release('u1')
+    assert locks._locks == {}
+
+
+def test_keyed_lock_waiter_keeps_the_lock_alive():
+    locks = app.KeyedLocks()
+    locks.acquire('u1')
+    acquired = threading.Event()
+
+    def wait_for_lock():
+        if locks.acquire('u1', timeout=2):
+            acquired.set()
+            locks.release('u1')
+
+    thread = threading.Thread(target=wait_for_lock)
+    thread.start()
+    while locks._locks['u1'][1] < 2:
+        time.sleep(0.001)
+    locks.release('u1')
+    thread.join(2)
+    assert acquired.is_set()
+    assert locks._locks == {}
+
+
+def test_duplicate_request_waits_for_the_owner_and_gets_its_result():
+    store = app.IdempotencyStore()
+    owner, entry = store.begin('k1')
+    assert owner
+    is_owner, duplicate = store.begin('k1')
+    assert not is_owner and duplicate is entry
+    results = []
+    thread = threading.Thread(target=lambda: results.append(store.wait(duplicate, 2)))
+    thread.start()
+    store.complete('k1', {'response': 'hi'})
+    thread.join(2)
+    assert results == [{'response': 'hi'}]
+    # Later retries replay the stored result without waiting
+    is_owner, replay = store.begin('k1')
+    assert not is_owner and store.wait(replay, 0) == {'response': 'hi'}
+
+
+def test_failed_request_frees_the_key_for_a_retry():
+    store = app.IdempotencyStore()
+    _, entry = store.begin('k1')
+    store.complete('k1', None)
+    assert store.wait(entry, 0) is None
+    assert store.begin('k1')[0]
+
+
+def test_wait_gives_up_at_the_timeout():
+    store = app.IdempotencyStore()
+    store.begin('k1')
+    _, entry = store.begin('k1')
+    assert store.wait(entry, 0.01) is None
+
+
+def test_finished_results_expire_after_the_ttl():
+    store = app.IdempotencyStore(ttl=0)
+    store.begin('k1')
+    store.complete('k1', {'response': 'hi'})
+    assert store.begin('k1')[0]
+
+
+def test_only_finished_results_are_evicted_past_max_size():
+    store = app.IdempotencyStore(max_size=2)
+    store.begin('in-flight')
+    for key in ('a', 'b', 'c'):
+        store.begin(key)
+        store.complete(key, {'response': key})
+    assert list(store._entries) == ['in-flight', 'c']
+    assert store.begin('a')[0]
+    assert not store.begin('in-flight')[0]
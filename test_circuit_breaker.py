@@ -0,0 +1,94 @@
+"""Tests for the Supabase circuit breaker
+
+Run with: python -m pytest -q
+"""
+import threading
+import time
+
+import pytest
+
+import app
+from fake_supabase import FakeSupabaseError
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.005)
+
+
+def fail():
+    raise ConnectionError("unreachable")
+
+
+def test_breaker_opens_then_half_opens_then_closes():
+    breaker = app.CircuitBreaker('Test', failure_threshold=2, reset_timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(app.StorageUnavailable):
+            breaker.call(fail, timeout=1)
+    assert breaker.state == 'open'
+
+    calls = []
+    with pytest.raises(app.StorageUnavailable) as raised:
+        breaker.call(lambda: calls.append(1), timeout=1)
+    assert calls == []
+    assert 0 < raised.value.retry_after <= 0.05
+    assert breaker.rejected == 1
+
+    time.sleep(0.06)
+    seen_state = []
+    assert breaker.call(lambda: seen_state.append(breaker.state) or 'ok', timeout=1) == 'ok'
+    assert seen_state == ['half_open']
+    assert breaker.state == 'closed'
+    assert breaker.failures == 0
+    assert breaker.opens == 1
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = app.CircuitBreaker('Test', failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(app.StorageUnavailable):
+        breaker.call(fail, timeout=1)
+    time.sleep(0.06)
+    with pytest.raises(app.StorageUnavailable):
+        breaker.call(fail, timeout=1)
+    assert breaker.state == 'open'
+    assert breaker.opens == 2
+
+
+def test_half_open_lets_one_probe_through_at_a_time():
+    breaker = app.CircuitBreaker('Test', failure_threshold=1, reset_timeout=0.01)
+    with pytest.raises(app.StorageUnavailable):
+        breaker.call(fail, timeout=1)
+    time.sleep(0.02)
+
+    probing = threading.Event()
+    release = threading.Event()
+    probe = threading.Thread(target=breaker.call, args=(lambda: probing.set() or release.wait(2), 1))
+    probe.start()
+    assert probing.wait(2)
+    with pytest.raises(app.StorageUnavailable):
+        breaker.call(lambda: None, timeout=1)
+    release.set()
+    probe.join()
+    wait_for(lambda: breaker.state == 'closed')
+
+
+def test_service_errors_pass_through_without_opening():
+    breaker = app.CircuitBreaker('Test', failure_threshold=1)
+
+    def duplicate():
+        raise FakeSupabaseError('duplicate key value', '23505')
+
+    with pytest.raises(FakeSupabaseError):
+        breaker.call(duplicate, timeout=1)
+    assert breaker.state == 'closed'
+
+
+def test_timed_out_call_counts_as_failure():
+    breaker = app.CircuitBreaker('Test', failure_threshold=1)
+    with pytest.raises(app.StorageUnavailable):
+        breaker.call(lambda: time.sleep(0.2), timeout=0.01)
+    assert breaker.timeouts == 1
+    assert breaker.state == 'open'
@@ -0,0 +1,111 @@
+"""Tests for the Gemini request scheduler: rate limiting, fairness and retries
+
+Run with: python -m pytest -q
+"""
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.001)
+
+
+def test_tokens_go_round_robin_across_users():
+    # A user with several queued requests can't starve one who queued later
+    scheduler = app.GeminiScheduler(rate_per_minute=0.001, burst=1, max_queue=10)
+    scheduler._tokens = 0.0
+    order = []
+    threads = []
+    for user in ('a', 'a', 'a', 'b'):
+        thread = threading.Thread(target=lambda user=user: (scheduler.acquire(user, time.monotonic() + 5), order.append(user)))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: scheduler._queued == len(threads))
+
+    # Open the tap: one token every 20ms
+    with scheduler._cond:
+        scheduler.rate = 50.0
+        scheduler._cond.notify_all()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['a', 'b', 'a', 'a']
+
+
+def test_burst_is_served_without_waiting():
+    scheduler = app.GeminiScheduler(rate_per_minute=0.001, burst=2)
+    deadline = time.monotonic() + 1
+    scheduler.acquire('a', deadline)
+    scheduler.acquire('a', deadline)
+    with pytest.raises(app.GeminiBusyError):
+        scheduler.acquire('a', time.monotonic() + 0.05)
+    assert scheduler.rejected == 1
+    assert scheduler.stats()['queued'] == 0
+
+
+def test_full_queue_is_rejected_at_once():
+    scheduler = app.GeminiScheduler(rate_per_minute=0.001, burst=1, max_queue=1)
+    scheduler._tokens = 0.0
+    errors = []
+
+    def queued():
+        try:
+            scheduler.acquire('a', time.monotonic() + 0.5)
+        except app.GeminiBusyError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=queued)
+    thread.start()
+    wait_for(lambda: scheduler._queued == 1)
+    started = time.monotonic()
+    with pytest.raises(app.GeminiBusyError):
+        scheduler.acquire('b', time.monotonic() + 5)
+    assert time.monotonic() - started < 0.5
+    thread.join(2)
+    # The queued request timed out at its own deadline
+    assert len(errors) == 1
+    assert scheduler.rejected == 2
+
+
+def test_rate_limits_are_retried_and_empty_the_bucket():
+    scheduler = app.GeminiScheduler(rate_per_minute=600, burst=5, base_backoff=0)
+    calls = []
+
+    def generate():
+        calls.append(scheduler._tokens)
+        if len(calls) < 3:
+            raise RateLimited("429 Resource exhausted")
+        return 'ok'
+
+    started = time.monotonic()
+    assert scheduler.call('a', generate, timeout=5) == 'ok'
+    assert len(calls) == 3
+    assert scheduler.rate_limited == 2
+    # The burst was left over, but each retry waited for a fresh token (100ms)
+    assert calls[0] >= 4
+    assert calls[1] < 1 and calls[2] < 1
+    assert time.monotonic() - started >= 0.15
+
+
+def test_other_errors_are_not_retried():
+    scheduler = app.GeminiScheduler(base_backoff=0)
+    calls = []
+
+    def generate():
+        calls.append(1)
+        raise ValueError("blocked prompt")
+
+    with pytest.raises(ValueError):
+        scheduler.call('a', generate)
+    assert len(calls) == 1
@@ -0,0 +1,126 @@
+"""Tests for chat search: tokenizing, snippets, MessageIndex and the storage backends' search
+
+Run with: python -m pytest -q
+"""
+import sqlite3
+
+import pytest
+
+import app
+from fake_supabase import FakeSupabaseClient
+from search import MessageIndex, make_snippet, search_terms
+
+
+def test_index_keeps_a_running_total_length():
+    index = MessageIndex()
+    index.add(1, 'one two three')
+    index.add(2, 'four')
+    assert index.total_length == 4
+    assert index.total_length == sum(index.lengths.values())
+
+
+def message(seq, content):
+    return {'seq': seq, 'role': 'user', 'content': content, 'timestamp': f'2024-01-01T00:00:{seq:02d}+00:00'}
+
+
+def test_search_terms_are_lowercased_words():
+    assert search_terms("Hello, WORLD! it's 2024") == ['hello', 'world', 'it', 's', '2024']
+
+
+def test_snippet_marks_matches_and_the_last_term_as_a_prefix():
+    assert make_snippet('Going hiking in the hills', ['hik']) == 'Going **hiking** in the hills'
+    assert make_snippet('the hills are nice', ['the', 'hi']) == '**the** **hills** are nice'
+
+
+def test_snippet_of_a_long_message_is_cut_around_the_match():
+    content = ' '.join(f'w{i}' for i in range(40)) + ' target ' + ' '.join(f'x{i}' for i in range(40))
+    snippet = make_snippet(content, ['target'], words=8)
+    assert snippet.startswith('…') and snippet.endswith('…')
+    assert '**target**' in snippet
+    assert len(snippet.split()) == 8
+
+
+def test_snippet_without_a_match_starts_at_the_beginning():
+    assert make_snippet('nothing to see here', ['zzz'], words=2) == 'nothing to…'
+
+
+def test_index_matches_every_term_with_the_last_as_a_prefix():
+    index = MessageIndex()
+    index.add(1, 'I love hiking')
+    index.add(2, 'I love hills')
+    index.add(3, 'hiking is tiring')
+    assert sorted(index.search(['love', 'hi'])) == [1, 2]
+    # Only the last term is expanded
+    assert index.search(['hi', 'love']) == []
+    assert index.search(['nothing']) == []
+
+
+def test_index_ranks_denser_matches_first():
+    index = MessageIndex()
+    index.add(1, 'coffee and a long walk along the river this morning')
+    index.add(2, 'coffee coffee')
+    index.add(3, 'tea')
+    assert index.search(['coffee']) == [2, 1]
+
+
+def test_index_ties_go_to_the_newest_message():
+    index = MessageIndex()
+    index.add(1, 'good night')
+    index.add(2, 'good night')
+    assert index.search(['night']) == [2, 1]
+
+
+def test_sqlite_search_matches_prefixes_and_marks_snippets(tmp_path):
+    store = app.SQLiteChatStore(app.SQLiteDatabase(str(tmp_path / 'chat.db')))
+    store.append('u1', [message(1, 'We went hiking'), message(2, 'Nice hills'), message(3, 'or not')])
+    store.append('u2', [message(1, 'hiking too')])
+    hits = store.search('u1', ['hi'])
+    assert sorted(hit['seq'] for hit in hits) == [1, 2]
+    assert {hit['snippet'] for hit in hits} == {'We went **hiking**', 'Nice **hills**'}
+    # FTS5 operators in a term are searched as plain words
+    assert store.search('u1', ['or']) == [{'seq': 3, 'role': 'user', 'timestamp': message(3, '')['timestamp'], 'snippet': '**or** not'}]
+    assert store.search('u1', ['not', 'and']) == []
+
+
+def test_sqlite_search_quotes_user_ids(tmp_path):
+    store = app.SQLiteChatStore(app.SQLiteDatabase(str(tmp_path / 'chat.db')))
+    store.append('a"b', [message(1, 'hello')])
+    store.append('ab', [message(1, 'hello')])
+    assert [hit['seq'] for hit in store.search('a"b', ['hello'])] == [1]
+    assert [hit['seq'] for hit in store.search('a" OR "b', ['hello'])] == []
+
+
+def test_sqlite_search_index_is_backfilled_once(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    app.SQLiteChatStore(app.SQLiteDatabase(path)).append('u1', [message(1, 'hello there')])
+    # An older database: messages saved before the search index existed
+    with sqlite3.connect(path) as conn:
+        conn.executescript("DROP TRIGGER chat_messages_fts_insert; DROP TABLE chat_messages_fts;")
+    app.SQLiteDatabase(path)
+    app.SQLiteDatabase(path)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat_messages_fts").fetchone()[0] == 1
+    assert [hit['seq'] for hit in app.SQLiteChatStore(app.SQLiteDatabase(path)).search('u1', ['hello'])] == [1]
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_fake_supabase_index_follows_inserts_and_upserts(write_behind):
+    client = FakeSupabaseClient()
+    backend = app.SupabaseBackend(client, write_behind=write_behind)
+    backend.append_messages('u1', [message(1, 'first hike'), message(2, 'second hike')])
+    backend.flush()
+    backend.append_messages('u1', [message(3, 'third hike')])
+    backend.flush()
+    hits = backend.search_messages('u1', ['hik'])
+    assert sorted(hit['seq'] for hit in hits) == [1, 2, 3]
+    assert {hit['snippet'] for hit in hits} == {'first **hike**', 'second **hike**', 'third **hike**'}
+    assert backend.search_messages('u2', ['hik']) == []
+
+
+def test_memory_and_sqlite_search_find_the_same_messages(tmp_path):
+    # Ranking may differ: FTS5 takes its BM25 statistics from the whole index
+    stores = [app.MemoryChatStore(), app.SQLiteChatStore(app.SQLiteDatabase(str(tmp_path / 'chat.db')))]
+    for store in stores:
+        store.append('u1', [message(1, 'tea time'), message(2, 'time for tea and more tea'), message(3, 'coffee')])
+    results = [sorted((hit['seq'], hit['snippet']) for hit in store.search('u1', ['tea'])) for store in stores]
+    assert results[0] == results[1]
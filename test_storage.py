@@ -0,0 +1,225 @@
+"""Tests for the write-behind queue, pending-message merging and message seqs
+
+Run with: python -m pytest -q
+"""
+import threading
+
+import app
+from fake_supabase import FakeSupabaseClient, FakeSupabaseError, FakeSupabaseQuery
+
+
+def message(seq, content='hi'):
+    return {'seq': seq, 'role': 'user', 'content': content, 'timestamp': f'2024-01-01T00:00:{seq:02d}+00:00'}
+
+
+def test_merge_pending_drops_messages_already_stored():
+    # A read can see a message both in storage and in flight while its write lands
+    stored = [message(1), message(2), message(3)]
+    pending = [message(3), message(4), message(5)]
+    merged = app.merge_pending(stored, pending)
+    assert [msg['seq'] for msg in merged] == [1, 2, 3, 4, 5]
+
+
+def test_merge_pending_without_pending_returns_stored():
+    stored = [message(1)]
+    assert app.merge_pending(stored, []) is stored
+
+
+def test_pending_includes_in_flight_and_queued_messages():
+    release = threading.Event()
+    started = threading.Event()
+    written = []
+
+    def write_batch(batch):
+        started.set()
+        release.wait(2)
+        written.extend(msg for msgs in batch.values() for msg in msgs)
+
+    writer = app.ChatWriteBehind(write_batch, interval=0)
+    writer.enqueue('u1', [message(1), message(2)])
+    assert started.wait(2)
+    # Queued while the first batch is still being written
+    writer.enqueue('u1', [message(3)])
+    assert [msg['seq'] for msg in writer.pending('u1')] == [1, 2, 3]
+    assert writer.depth() == 3
+
+    release.set()
+    assert writer.flush(timeout=2)
+    assert writer.pending('u1') == []
+    assert [msg['seq'] for msg in written] == [1, 2, 3]
+
+
+def test_flush_times_out_while_a_write_is_stuck():
+    release = threading.Event()
+    writer = app.ChatWriteBehind(lambda batch: release.wait(2), interval=0)
+    writer.enqueue('u1', [message(1)])
+    assert writer.flush(timeout=0.05) is False
+    assert len(writer.pending('u1')) == 1
+    release.set()
+    assert writer.flush(timeout=2)
+
+
+def test_backend_flush_on_shutdown_writes_queued_messages():
+    # worker_exit and atexit call STORAGE.flush(); nothing queued may be lost
+    client = FakeSupabaseClient(latency_ms=20)
+    backend = app.SupabaseBackend(client, write_behind=True)
+    backend.append_messages('u1', [message(1), message(2)])
+    backend.append_messages('u2', [message(1)])
+    assert client.tables.get('chat_messages', []) == []
+
+    backend.flush()
+    rows = client.tables['chat_messages']
+    assert sorted((row['user_id'], row['seq']) for row in rows) == [('u1', 1), ('u1', 2), ('u2', 1)]
+    assert backend.writer.depth() == 0
+
+
+def test_failed_batch_is_retried_then_dropped():
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(batch)
+        raise app.StorageUnavailable("down", retry_after=0)
+
+    writer = app.ChatWriteBehind(write_batch, interval=0, max_retries=2, base_backoff=0)
+    writer.enqueue('u1', [message(1)])
+    assert writer.flush(timeout=2)
+    assert len(attempts) == 3
+    assert writer.failed_batches == 3
+    assert writer.dropped_messages == 1
+    assert writer.pending('u1') == []
+
+
+def test_rejected_batch_is_not_retried():
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(batch)
+        raise FakeSupabaseError('null value in column "content"', '23502')
+
+    writer = app.ChatWriteBehind(write_batch, interval=0, max_retries=5, base_backoff=10)
+    writer.enqueue('u1', [message(1)])
+    assert writer.flush(timeout=2)
+    assert len(attempts) == 1
+    assert writer.dropped_messages == 1
+
+
+def test_rewriting_stored_rows_is_a_no_op():
+    # A write that timed out after landing is retried without a duplicate key error
+    client = FakeSupabaseClient()
+    backend = app.SupabaseBackend(client, write_behind=True)
+    backend.append_messages('u1', [message(1), message(2)])
+    backend.flush()
+    backend.writer.enqueue('u1', [message(1), message(2)])
+    backend.writer.enqueue('u2', [message(1)])
+    backend.flush()
+    assert backend.writer.dropped_messages == 0
+    assert backend.writer.failed_batches == 0
+    assert sorted((row['user_id'], row['seq']) for row in client.tables['chat_messages']) == [('u1', 1), ('u1', 2), ('u2', 1)]
+
+
+def test_taken_seqs_are_renumbered_after_the_stored_messages():
+    # Another worker saved a turn for the same user with the seqs this turn picked
+    client = FakeSupabaseClient()
+    backend = app.SupabaseBackend(client, write_behind=False)
+    backend.append_messages('u1', [message(1, 'other worker'), message(2, 'other reply')])
+    mine = [message(1, 'mine'), message(2, 'my reply')]
+    backend.append_messages('u1', mine)
+    assert [msg['seq'] for msg in mine] == [3, 4]
+    stored = sorted(client.tables['chat_messages'], key=lambda row: row['seq'])
+    assert [(row['seq'], row['content']) for row in stored] == [
+        (1, 'other worker'), (2, 'other reply'), (3, 'mine'), (4, 'my reply')
+    ]
+
+
+def test_write_behind_renumbers_instead_of_dropping():
+    client = FakeSupabaseClient()
+    backend = app.SupabaseBackend(client, write_behind=True)
+    backend.append_messages('u1', [message(1, 'other worker')])
+    backend.flush()
+    backend.append_messages('u1', [message(1, 'mine')])
+    backend.flush()
+    assert backend.writer.dropped_messages == 0
+    assert sorted(row['seq'] for row in client.tables['chat_messages']) == [1, 2]
+
+
+def test_one_bad_user_does_not_sink_the_batch():
+    written = []
+
+    def write_batch(batch):
+        if 'bad' in batch:
+            raise ValueError("bad row")
+        written.extend(app.message_row(user_id, msg) for user_id, msgs in batch.items() for msg in msgs)
+
+    writer = app.ChatWriteBehind(write_batch, interval=0.02, max_retries=1, base_backoff=0)
+    writer.enqueue('good', [message(1), message(2)])
+    writer.enqueue('bad', [message(1)])
+    assert writer.flush(timeout=2)
+    assert sorted(row['seq'] for row in written) == [1, 2]
+    assert {row['user_id'] for row in written} == {'good'}
+    assert writer.dropped_messages == 1
+
+
+def test_sqlite_append_renumbers_seqs_another_worker_took(tmp_path):
+    # Two workers share the file; each numbered its turn from the tail it loaded
+    path = str(tmp_path / 'chat.db')
+    first, second = app.SQLiteChatStore(app.SQLiteDatabase(path)), app.SQLiteChatStore(app.SQLiteDatabase(path))
+    first.append('u1', [message(1, 'first'), message(2, 'first reply')])
+    mine = [message(1, 'second'), message(2, 'second reply')]
+    second.append('u1', mine)
+    assert [msg['seq'] for msg in mine] == [3, 4]
+    assert [(msg['seq'], msg['content']) for msg in first.get_messages('u1')] == [
+        (1, 'first'), (2, 'first reply'), (3, 'second'), (4, 'second reply')
+    ]
+
+
+def test_sqlite_append_keeps_seqs_that_are_free(tmp_path):
+    store = app.SQLiteChatStore(app.SQLiteDatabase(str(tmp_path / 'chat.db')))
+    store.append('u1', [message(1)])
+    later = [message(2)]
+    store.append('u1', later)
+    assert later[0]['seq'] == 2
+    assert store.last_seq('u1') == 2
+
+
+class MissingChatsTableQuery(FakeSupabaseQuery):
+    """Query on a table that was never created, as PostgREST reports it"""
+
+    def execute(self):
+        self.client.chats_queries += 1
+        raise FakeSupabaseError('relation "public.chats" does not exist', '42P01')
+
+
+class NoChatsTableClient(FakeSupabaseClient):
+    """Fresh install: no legacy chats table"""
+
+    def __init__(self):
+        super().__init__()
+        self.chats_queries = 0
+
+    def table(self, name):
+        if name == 'chats':
+            return MissingChatsTableQuery(self, name)
+        return super().table(name)
+
+
+def test_fresh_install_without_chats_table_has_empty_history():
+    client = NoChatsTableClient()
+    backend = app.SupabaseBackend(client, write_behind=False)
+    assert backend.get_all_messages('u1') == []
+    assert backend.get_messages_page('u1') == []
+    assert backend.migrate_all_chat_blobs() == 0
+    # The missing table is only looked up once
+    assert client.chats_queries == 1
+    assert backend.breaker.state == 'closed'
+
+
+def test_legacy_chat_blob_is_migrated_once():
+    client = FakeSupabaseClient()
+    client.tables['chats'] = [{'id': 'c1', 'user_id': 'u1', 'messages': [
+        {'role': 'user', 'content': 'hello', 'timestamp': '2024-01-01T00:00:00+00:00'},
+        {'role': 'assistant', 'content': 'hi there', 'timestamp': '2024-01-01T00:00:01+00:00'},
+    ]}]
+    backend = app.SupabaseBackend(client, write_behind=False)
+    assert [(msg['seq'], msg['content']) for msg in backend.get_all_messages('u1')] == [(1, 'hello'), (2, 'hi there')]
+    assert backend.migrate_all_chat_blobs() == 0
+    assert len(client.tables['chat_messages']) == 2